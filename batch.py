@@ -0,0 +1,252 @@
+import argparse
+import csv
+import inspect
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import as_completed
+from contextlib import nullcontext
+import skimage.io as skio
+from feature_cache import FeatureCache
+from pipeline import stitch
+from profiling import Profiler
+
+# Parameters of stitch that can be set per job in a manifest.
+JOB_PARAMS = {name: param.default for name, param in
+    inspect.signature(stitch).parameters.items()
+    if param.default is not inspect.Parameter.empty and
+    name not in ("max_workers", "cache", "executor", "report")}
+
+# Types of the job parameters that default to None. overlap_prior may also
+# be a list of matrices in a JSON manifest.
+OPTIONAL_PARAM_TYPES = {"match_threshold": float, "seed": int,
+    "guided_pts": int, "overlap_prior": (str, float),
+    "ransac_confidence": float}
+
+
+def load_manifest(path):
+    """
+    Read the jobs of a manifest. A JSON manifest is a list of jobs (or an
+    object with a "jobs" list), each with a "name", a list of "images" and
+    optional stitch parameters. A CSV manifest has a "name" column, an
+    "images" column of paths separated by ";", and optional columns of
+    stitch parameters; empty cells keep the default.
+    Image paths are relative to the directory of the manifest. Job names,
+    and the optional "output" file name of a job, name files in the output
+    directory, so they must be unique plain file names.
+    :param path: Path of the manifest, ending in .json or .csv.
+    """
+    if path.endswith(".csv"):
+        with open(path, newline = "") as f:
+            jobs = [{key: value for key, value in row.items() if value != ""}
+                for row in csv.DictReader(f)]
+        for job in jobs:
+            job["images"] = job["images"].split(";")
+    else:
+        with open(path) as f:
+            jobs = json.load(f)
+        if isinstance(jobs, dict):
+            jobs = jobs["jobs"]
+
+    root = os.path.dirname(os.path.abspath(path))
+    for i, job in enumerate(jobs):
+        job.setdefault("name", f"job{i}")
+        for key in ("name", "output"):
+            if key in job:
+                _check_file_name(job[key])
+        job["images"] = [os.path.join(root, image) for image in job["images"]]
+        unknown = set(job) - set(JOB_PARAMS) - {"name", "images", "output"}
+        if unknown:
+            raise ValueError(f"Unknown parameters in job {job['name']}: " +
+                ", ".join(sorted(unknown)))
+        for name in set(job) & set(JOB_PARAMS):
+            try:
+                job[name] = _parse_value(name, job[name])
+            except ValueError as error:
+                raise ValueError(f"Invalid parameter in job {job['name']}: " +
+                    str(error)) from None
+    names = [job["name"] for job in jobs]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError("Duplicate job names: " +
+            ", ".join(sorted(duplicates)))
+    return jobs
+
+
+def run_job(job, output_dir, threads = 1, cache_dir = None, profile = False):
+    """
+    Stitch the images of one job, save the panorama, and write the report
+    of the job as JSON next to it. Errors are recorded in the report
+    instead of being raised. Returns the report.
+    :param job: Job of a manifest, as returned by load_manifest.
+    :param output_dir: Directory of the panoramas and reports.
+    :param threads: Number of threads used within the job.
+    :param cache_dir: Optional directory of a FeatureCache.
+    :param profile: If True, add the time, memory and counts of every stage
+        to the report, and write them as a Chrome trace next to it.
+    """
+    name = job["name"]
+    _check_file_name(name)
+    _check_file_name(job.get("output", name + ".png"))
+    output = os.path.join(output_dir, job.get("output", name + ".png"))
+    report = {"name": name, "images": job["images"], "output": output}
+    params = {key: job[key] for key in JOB_PARAMS if key in job}
+    cache = None if cache_dir is None else FeatureCache(cache_dir)
+    profiler = Profiler() if profile else nullcontext()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        with profiler, ThreadPoolExecutor(max_workers = threads) as executor:
+            panorama, offset, homographies = stitch(job["images"],
+                cache = cache, executor = executor, report = report,
+                **params)
+        start = time.perf_counter()
+        skio.imsave(output, panorama, check_contrast = False)
+        report["timings"]["save"] = time.perf_counter() - start
+        report["status"] = "ok"
+        report["offset"] = [float(x) for x in offset]
+        report["shape"] = list(panorama.shape)
+        report["homographies"] = [None if H is None else H.tolist()
+            for H in homographies]
+    except Exception as error:
+        report["status"] = "failed"
+        report["error"] = f"{type(error).__name__}: {error}"
+        report["traceback"] = traceback.format_exc()
+    report["wall_time"] = time.perf_counter() - start_wall
+    report["cpu_time"] = time.process_time() - start_cpu
+    if profile:
+        report["profile"] = profiler.summary()
+        profiler.write_trace(os.path.join(output_dir, name + ".trace.json"))
+
+    with open(os.path.join(output_dir, name + ".json"), "w") as f:
+        json.dump(report, f, indent = 2, default = _to_json)
+    return report
+
+
+def run_batch(jobs, output_dir, max_workers = None, threads = 1,
+    cache_dir = None, profile = False):
+    """
+    Run jobs in a pool of long-lived worker processes, so that the
+    interpreter and the imports are paid for once per worker rather than
+    once per job. Returns the reports of all jobs, in the order of jobs.
+    :param jobs: Jobs, as returned by load_manifest.
+    :param output_dir: Directory of the panoramas and reports.
+    :param max_workers: Number of worker processes. Defaults to the number
+        of processors.
+    :param threads: Number of threads used within each job.
+    :param cache_dir: Optional directory of a FeatureCache shared by all
+        workers.
+    :param profile: If True, profile every job (see run_job).
+    """
+    os.makedirs(output_dir, exist_ok = True)
+    reports = [None] * len(jobs)
+    with ProcessPoolExecutor(max_workers = max_workers) as executor:
+        futures = {executor.submit(run_job, job, output_dir, threads,
+            cache_dir, profile): i for i, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            report = future.result()
+            reports[futures[future]] = report
+            print(f"{report['name']}: {report['status']} "
+                f"({report['wall_time']:.1f} s)", file = sys.stderr)
+    return reports
+
+
+def main(argv = None):
+    """
+    Command-line entry point: stitch every job of a manifest without any
+    window or prompt, and write a summary of all reports.
+    """
+    parser = argparse.ArgumentParser(description = "Stitch the image sets "
+        "of a JSON or CSV manifest into panoramas.")
+    parser.add_argument("manifest", help = "path of the manifest")
+    parser.add_argument("-o", "--output-dir", default = "panoramas",
+        help = "directory of the panoramas and reports")
+    parser.add_argument("-w", "--workers", type = int, default = None,
+        help = "number of worker processes (default: number of processors)")
+    parser.add_argument("-t", "--threads", type = int, default = 1,
+        help = "number of threads within each job")
+    parser.add_argument("--cache", default = None,
+        help = "directory of a feature cache shared by all jobs")
+    parser.add_argument("--profile", action = "store_true",
+        help = "record per-stage timings, memory and counts of every job")
+    args = parser.parse_args(argv)
+
+    jobs = load_manifest(args.manifest)
+    reports = run_batch(jobs, args.output_dir, max_workers = args.workers,
+        threads = args.threads, cache_dir = args.cache,
+        profile = args.profile)
+    summary = [{key: report.get(key) for key in ("name", "status", "output",
+        "wall_time", "error")} for report in reports]
+    with open(os.path.join(args.output_dir, "summary.json"), "w") as f:
+        json.dump(summary, f, indent = 2)
+    return 0 if all(report["status"] == "ok" for report in reports) else 1
+
+
+def _check_file_name(name):
+    """
+    Raise ValueError unless name is a plain file name, which cannot escape
+    the output directory.
+    """
+    separators = {"/", "\\", os.sep, os.altsep} - {None}
+    if not isinstance(name, str) or name in ("", ".", "..") or \
+        any(separator in name for separator in separators):
+        raise ValueError("Job names and outputs must be file names " +
+            f"without path separators, got {name!r}")
+
+
+def _parse_value(name, value):
+    """
+    Convert a manifest value (a string when read from CSV) to the type of a
+    parameter of stitch: the type of its default value, or the type in
+    OPTIONAL_PARAM_TYPES if it defaults to None. Integer parameters also
+    accept decimals with no fractional part. Raises ValueError if the value
+    does not have that type.
+    :param name: Name of the parameter.
+    :param value: Value from the manifest.
+    """
+    default = JOB_PARAMS[name]
+    kind = type(default) if default is not None else \
+        OPTIONAL_PARAM_TYPES[name]
+    kinds = kind if isinstance(kind, tuple) else (kind,)
+    if value is None and default is None:
+        return None
+    if name == "overlap_prior" and isinstance(value, list):
+        return value
+    if isinstance(value, str):
+        text = value.strip()
+        if bool in kinds:
+            if text.lower() in ("1", "true", "yes"):
+                return True
+            if text.lower() in ("0", "false", "no"):
+                return False
+        elif float in kinds or int in kinds:
+            try:
+                value = float(text)
+            except ValueError:
+                if str in kinds:
+                    return value
+        elif str in kinds:
+            return value
+    # Booleans are integers in Python, but not valid numbers here.
+    if isinstance(value, bool) and bool in kinds:
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if float in kinds:
+            return float(value)
+        if int in kinds and float(value).is_integer():
+            return int(value)
+    expected = " or ".join(kind.__name__ for kind in kinds)
+    raise ValueError(f"{name} must be {expected}, got {value!r}")
+
+
+def _to_json(value):
+    """
+    Convert NumPy scalars and arrays for json.dump.
+    """
+    return value.tolist() if hasattr(value, "tolist") else str(value)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
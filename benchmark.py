@@ -0,0 +1,213 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import numpy as np
+import scipy
+import scipy.ndimage as ndimage
+import skimage
+from harris import get_harris_corners, dist2
+from non_max_suppression import non_max_suppression
+from descriptor_extraction import extract_descriptor
+from feature_matching import match_feature
+from ransac import ransac
+from warp_image import warpImage
+from profiling import Profiler
+
+
+def synthetic_image(shape, seed = 0, feature_size = 8):
+    """
+    Generate a gray-scale uint8 image of random blobs, rich in corners at
+    every resolution.
+    :param shape: (height, width) of the image.
+    :param seed: Seed of the random number generator.
+    :param feature_size: Approximate size of the blobs in pixels.
+    """
+    rng = np.random.default_rng(seed)
+    coarse = rng.random((shape[0] // feature_size + 2,
+        shape[1] // feature_size + 2), dtype = np.float32)
+    im = ndimage.zoom(coarse, feature_size, order = 1)[:shape[0], :shape[1]]
+    im = ndimage.gaussian_filter(im, feature_size / 4)
+    im -= im.min()
+    im *= 255 / max(im.max(), 1e-6)
+    return im.astype(np.uint8)
+
+
+def synthetic_homography(shape, seed = 0):
+    """
+    Random projective transformation of pixel locations (row, col) with a
+    small rotation, scaling, shift and perspective around the image center.
+    :param shape: (height, width) of the image.
+    :param seed: Seed of the random number generator.
+    """
+    rng = np.random.default_rng(seed)
+    angle = rng.uniform(-0.05, 0.05)
+    scale = rng.uniform(0.95, 1.05)
+    shift = rng.uniform(-0.05, 0.05, 2) * np.array(shape)
+    perspective = rng.uniform(-0.02, 0.02, 2) / np.array(shape)
+    center = np.array(shape) / 2
+    to_center = np.array([[1, 0, -center[0]], [0, 1, -center[1]], [0, 0, 1]])
+    H = np.array([[scale * np.cos(angle), -scale * np.sin(angle), shift[0]],
+        [scale * np.sin(angle), scale * np.cos(angle), shift[1]],
+        [perspective[0], perspective[1], 1]])
+    H = np.dot(np.linalg.inv(to_center), np.dot(H, to_center))
+    return H / H[2, 2]
+
+
+def synthetic_pair(megapixels, seed = 0):
+    """
+    Generate a pair of images and the ground-truth projective transformation
+    from image 1 to image 2. Image 2 is image 1 warped by it.
+    Returns image 1, image 2 and the transformation matrix.
+    :param megapixels: Size of the images in millions of pixels, with a
+        4:3 aspect ratio.
+    :param seed: Seed of the random number generator.
+    """
+    height = int(round(np.sqrt(megapixels * 1e6 * 3 / 4)))
+    width = int(round(height * 4 / 3))
+    im1 = synthetic_image((height, width), seed)
+    H = synthetic_homography((height, width), seed)
+    im2 = warpImage(im1, np.linalg.inv(H), (height, width))[:, :, 0]
+    return im1, im2, H
+
+
+def run_benchmark(megapixels = (1, 4, 12, 50), corners = (1000, 10000,
+    100000), seed = 0, memory = True, max_pts = 1000, dist2_max_bytes = 2 ** 30,
+    log = None):
+    """
+    Time and memory-profile every stage on synthetic image pairs. For every
+    resolution, the Harris detector and the warp run once on the images.
+    For every number of corners, that many random feature points of image 1
+    and their ground-truth locations in image 2 go through dist2,
+    non-max suppression, descriptor extraction, matching and RANSAC.
+    Returns a list of results, one per stage and sweep point, with the wall
+    time, CPU time, peak traced memory and counts of the stage.
+    :param megapixels: Resolutions of the sweep, in millions of pixels.
+    :param corners: Numbers of feature points of the sweep.
+    :param seed: Seed of the random number generators.
+    :param memory: If True, trace the peak memory of every stage.
+    :param max_pts: Number of feature points kept by non-max suppression.
+    :param dist2_max_bytes: dist2 is skipped when its output would be larger.
+    :param log: Optional file to report progress to.
+    """
+    results = []
+
+    def measure(profiler, stage, size, num_corners, function, *args,
+        **kwargs):
+        with profiler.stage(stage):
+            output = function(*args, **kwargs)
+        record = profiler.records[-1]
+        result = {"stage": stage, "megapixels": size,
+            "corners": num_corners, "wall_time": record["wall_time"],
+            "cpu_time": record["cpu_time"],
+            "peak_memory": record["peak_memory"], "counts": record["counts"]}
+        results.append(result)
+        if log is not None:
+            print(f"{stage:12s} {size:5g} MP {num_corners or '-':>7} corners"
+                f" {record['wall_time']:8.3f} s", file = log)
+        return output, result
+
+    rng = np.random.default_rng(seed)
+    with Profiler(memory = memory) as profiler:
+        for size in megapixels:
+            im1, im2, H_true = synthetic_pair(size, seed)
+            measure(profiler, "warp", size, None, warpImage, im1,
+                np.linalg.inv(H_true), im1.shape)
+            (h, _), _ = measure(profiler, "harris", size, None,
+                get_harris_corners, im1)
+
+            for num_corners in corners:
+                # Random feature points of image 1 whose ground-truth
+                # location in image 2 is far enough from the edges.
+                margin = 21
+                coords1 = np.stack((rng.integers(margin,
+                    im1.shape[0] - margin, num_corners), rng.integers(margin,
+                    im1.shape[1] - margin, num_corners)))
+                coords2 = np.dot(H_true, np.concatenate((coords1,
+                    np.ones((1, num_corners)))))
+                coords2 = np.rint(coords2[:2] / coords2[2]).astype(int)
+                inside = np.all((coords2 >= margin) & (coords2 <
+                    np.array(im2.shape)[:, np.newaxis] - margin), axis = 0)
+                coords1, coords2 = coords1[:, inside], coords2[:, inside]
+
+                if coords1.shape[1] ** 2 * 8 <= dist2_max_bytes:
+                    measure(profiler, "dist2", size, num_corners, dist2,
+                        coords1.T.astype(float), coords1.T.astype(float))
+                measure(profiler, "anms", size, num_corners,
+                    non_max_suppression, h, coords1, max_pts = max_pts)
+                descriptor1, _ = measure(profiler, "descriptors", size,
+                    num_corners, extract_descriptor, im1, coords1)
+                descriptor2 = extract_descriptor(im2, coords2)
+                # Shuffle image 2 so that matching cannot rely on order.
+                order = rng.permutation(coords2.shape[1])
+                (im1_coords, im2_coords), _ = measure(profiler, "matching",
+                    size, num_corners, match_feature, descriptor1,
+                    descriptor2[order], coords1, coords2[:, order], 0.27)
+                try:
+                    (H, _), result = measure(profiler, "ransac", size,
+                        num_corners, ransac, im1_coords, im2_coords,
+                        seed = seed)
+                except ValueError:
+                    continue
+                # Accuracy: mean distance between the points of image 1
+                # transformed by the estimate and by the ground truth.
+                result["reprojection_error"] = float(np.mean(np.linalg.norm(
+                    _project(H, coords1) - _project(H_true, coords1),
+                    axis = 0)))
+    return results
+
+
+def environment():
+    """
+    Versions and machine the benchmark runs on, and the current git commit.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"],
+            capture_output = True, text = True,
+            cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"commit": commit or None, "python": platform.python_version(),
+        "numpy": np.__version__, "scipy": scipy.__version__,
+        "skimage": skimage.__version__, "machine": platform.machine(),
+        "processors": os.cpu_count()}
+
+
+def main(argv = None):
+    """
+    Command-line entry point: run the sweep and write the results as JSON.
+    """
+    parser = argparse.ArgumentParser(description = "Time and memory-profile "
+        "every stage on synthetic image pairs.")
+    parser.add_argument("-o", "--output", default = "benchmark.json",
+        help = "path of the JSON results")
+    parser.add_argument("--megapixels", type = float, nargs = "+",
+        default = [1, 4, 12, 50], help = "resolutions of the sweep")
+    parser.add_argument("--corners", type = int, nargs = "+",
+        default = [1000, 10000, 100000], help = "numbers of feature points")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--no-memory", action = "store_true",
+        help = "do not trace memory (faster, no peak memory)")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.megapixels, args.corners, seed = args.seed,
+        memory = not args.no_memory, log = sys.stderr)
+    with open(args.output, "w") as f:
+        json.dump({"environment": environment(), "results": results}, f,
+            indent = 2)
+    return 0
+
+
+def _project(H, coords):
+    """
+    Transform pixel locations of shape (2, n) by H.
+    """
+    coords_trans = np.dot(H, np.concatenate((coords,
+        np.ones((1, coords.shape[1])))))
+    return coords_trans[:2] / coords_trans[2]
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+import numpy as np
+from warp_image import check_homography
+from warp_image import footprint, inverse_map, sample_image, cast_samples
+from profiling import profiled, count
+
+
+def panorama_bounds(images, homographies):
+    """
+    Compute the tight bounding box of a set of images warped onto a common
+    projection plane. Returns (r_min, r_max, c_min, c_max) in coordinates of
+    the common projection plane, with r_max and c_max exclusive.
+    :param images: images to be warped.
+    :param homographies: for each image, the reversed projective
+        transformation from the common projection plane to the image, as
+        passed to warpImage. The reference image uses the identity.
+    """
+    r_min, r_max, c_min, c_max = np.inf, -np.inf, np.inf, -np.inf
+    for i, (im, H) in enumerate(zip(images, homographies)):
+        check_homography(H)
+        height, width = im.shape[0], im.shape[1]
+        corners = np.array([[0, 0, height, height], [0, width, 0, width],
+            [1, 1, 1, 1]], dtype = np.float64)
+        corners_trans = np.dot(np.linalg.inv(H), corners)
+        if not (np.all(corners_trans[2] > 0) or np.all(corners_trans[2] < 0)):
+            raise ValueError(f"Image {i} crosses the line at infinity, so " +
+                "the panorama is unbounded.")
+        corners_trans = corners_trans[:2] / corners_trans[2]
+        r_min = min(r_min, np.min(corners_trans[0]))
+        r_max = max(r_max, np.max(corners_trans[0]))
+        c_min = min(c_min, np.min(corners_trans[1]))
+        c_max = max(c_max, np.max(corners_trans[1]))
+    return int(np.floor(r_min)), int(np.ceil(r_max)), \
+        int(np.floor(c_min)), int(np.ceil(c_max))
+
+
+@profiled("composite")
+def composite(images, homographies, blend = "feather", feather_width = 20,
+    order = 1, dtype = None):
+    """
+    Warp a set of images onto a common projection plane and composite them
+    into one panorama. The canvas is the tight bounding box of all warped
+    images and is allocated once; every image is blended into it in place.
+    Returns the panorama, of shape (height, width, num of channels), and the
+    offset (r_min, c_min) of its top-left pixel in the common projection
+    plane.
+    :param images: images to be composited. Gray-scale images are treated as
+        having a single channel.
+    :param homographies: for each image, the reversed projective
+        transformation from the common projection plane to the image, as
+        passed to warpImage. The reference image uses the identity.
+    :param blend: "feather" blends each image over the earlier ones with a
+        linear ramp of feather_width pixels along its borders. "none" keeps
+        the earlier images wherever images overlap.
+    :param feather_width: width in pixels of the feathering ramp.
+    :param order: order of interpolation, 1 for bilinear, 3 for bicubic.
+    :param dtype: data type of the panorama. Defaults to the data type of the
+        images.
+    """
+    if blend not in ("feather", "none"):
+        raise ValueError(f"Unknown blending mode: {blend}")
+    images = [np.expand_dims(im, axis = 2) if len(im.shape) == 2 else im
+        for im in images]
+    if dtype is None:
+        dtype = np.result_type(*[im.dtype for im in images])
+    r_min, r_max, c_min, c_max = panorama_bounds(images, homographies)
+    shape = (r_max - r_min, c_max - c_min)
+    canvas = np.zeros(shape + (images[0].shape[2],), dtype = dtype)
+    covered = np.zeros(shape, dtype = bool)
+
+    for im, H in zip(images, homographies):
+        blend_into(canvas, covered, (r_min, c_min), im, H, blend,
+            feather_width, order)
+    count("output_pixels", canvas.shape[0] * canvas.shape[1])
+    return canvas, (r_min, c_min)
+
+
+def blend_into(canvas, covered, origin, im, H, blend, feather_width, order):
+    """
+    Warp one image into a canvas whose top-left pixel is at origin
+    (r_min, c_min) of the common projection plane, and mark the pixels it
+    covers in covered. Used by composite and by StreamStitcher to add
+    images one at a time.
+    :param canvas: Output image, updated in place.
+    :param covered: Boolean mask of the canvas pixels covered so far,
+        updated in place.
+    :param origin: Location (r_min, c_min) of the top-left canvas pixel.
+    See composite for the other parameters.
+    """
+    # Shift the common projection plane so that the canvas starts at (0, 0).
+    offset = np.array([[1, 0, origin[0]], [0, 1, origin[1]], [0, 0, 1]],
+        dtype = np.float64)
+    shape = covered.shape
+    H_canvas = np.dot(H, offset)
+    r_start, r_stop, c_start, c_stop = footprint(H_canvas, im.shape, shape)
+    if r_start >= r_stop or c_start >= c_stop:
+        return
+    im_rr, im_cc = inverse_map(H_canvas, np.arange(r_start, r_stop),
+        np.arange(c_start, c_stop))
+    mask = (im_rr >= 0) & (im_rr < im.shape[0]) & \
+        (im_cc >= 0) & (im_cc < im.shape[1])
+    values = sample_image(im, im_rr, im_cc, order)
+    canvas_block = canvas[r_start: r_stop, c_start: c_stop]
+    covered_block = covered[r_start: r_stop, c_start: c_stop]
+
+    if blend == "feather":
+        # The weight of the new image ramps up from 0 on its borders to 1
+        # at feather_width pixels inside.
+        alpha = np.minimum(np.minimum(im_rr, im.shape[0] - 1 - im_rr),
+            np.minimum(im_cc, im.shape[1] - 1 - im_cc))
+        alpha = np.clip(alpha / max(feather_width, 1), 0, 1)
+        overlap = mask & covered_block
+        alpha = alpha[overlap].astype(np.float32)[:, np.newaxis]
+        previous = canvas_block[overlap].astype(np.float32)
+        values[overlap] = previous + alpha * (values[overlap] - previous)
+    else:
+        mask &= ~covered_block
+    canvas_block[mask] = cast_samples(values[mask], canvas.dtype)
+    covered_block |= mask
@@ -24,3 +24,161 @@ def computeH(im1_pts, im2_pts):
         [params[3], params[4], params[5]],
         [params[6], params[7], 1]])
     return H
+
+
+def computeH_batch(im1_pts, im2_pts):
+    """
+    Compute a batch of projective transformation matrices at once, one for
+    each set of point correspondences. Sets whose linear system is singular
+    (e.g. collinear points) get a matrix filled with NaN.
+    Output shape: (K, 3, 3)
+    :param im1_pts: Feature points in image 1, of shape (K, n, 2).
+    :param im2_pts: Feature points in image 2, of shape (K, n, 2).
+    """
+    num_sets, num_pts = im1_pts.shape[0], im1_pts.shape[1]
+    im2_pts_reshape = np.reshape(im2_pts, (num_sets, num_pts * 2))
+    A = np.zeros((num_sets, num_pts * 2, 8))
+    A[:, ::2, 0:2] = im1_pts
+    A[:, 1::2, 3:5] = im1_pts
+    A[:, ::2, 2] = 1
+    A[:, 1::2, 5] = 1
+    A[:, :, 6] = -np.repeat(im1_pts[:, :, 0], 2, axis = 1) * im2_pts_reshape
+    A[:, :, 7] = -np.repeat(im1_pts[:, :, 1], 2, axis = 1) * im2_pts_reshape
+    b = im2_pts_reshape[:, :, np.newaxis]
+    # With exactly 4 correspondences the system is square and is solved
+    # directly; otherwise solve the normal equations.
+    if num_pts != 4:
+        AT = np.swapaxes(A, 1, 2)
+        A, b = np.matmul(AT, A), np.matmul(AT, b)
+    try:
+        params = np.linalg.solve(A, b)[:, :, 0]
+    except np.linalg.LinAlgError:
+        # Some systems are singular. Solve the others one by one.
+        params = np.full((num_sets, 8), np.nan)
+        for i in range(num_sets):
+            try:
+                params[i] = np.linalg.solve(A[i], b[i])[:, 0]
+            except np.linalg.LinAlgError:
+                pass
+
+    H = np.ones((num_sets, 9))
+    H[:, :8] = params
+    return H.reshape((num_sets, 3, 3))
+
+
+def computeH_normalized(im1_pts, im2_pts):
+    """
+    Compute a batch of projective transformation matrices at once, like
+    computeH_batch, but on normalized coordinates: the points of every set
+    are translated and scaled so that their centroid is 0 and their mean
+    distance to it is sqrt(2) (Hartley normalization). This keeps the linear
+    systems well conditioned with pixel coordinates.
+    Output shape: (K, 3, 3)
+    :param im1_pts: Feature points in image 1, of shape (K, n, 2).
+    :param im2_pts: Feature points in image 2, of shape (K, n, 2).
+    """
+    T1 = _normalization(im1_pts)
+    T2 = _normalization(im2_pts)
+    H = computeH_batch(_transform(T1, im1_pts), _transform(T2, im2_pts))
+
+    # Undo the normalization.
+    H = np.matmul(np.linalg.inv(T2), np.matmul(H, T1))
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        return H / H[:, 2:3, 2:3]
+
+
+def refine_homography(H, im1_pts, im2_pts, max_iter = 20, tol = 1e-10):
+    """
+    Refine a projective transformation matrix with Levenberg-Marquardt, by
+    minimizing the sum of squared distances between the transformed points
+    of image 1 and the points of image 2. The Jacobian of all points is
+    computed at once, and the problem is solved in normalized coordinates
+    for conditioning.
+    :param H: Initial transformation matrix.
+    :param im1_pts: Feature points in image 1, of shape (n, 2).
+    :param im2_pts: Feature points in image 2, of shape (n, 2).
+    :param max_iter: Maximum number of iterations.
+    :param tol: Stop when an iteration reduces the error by less than this
+        fraction.
+    """
+    T1 = _normalization(im1_pts[np.newaxis])[0]
+    T2 = _normalization(im2_pts[np.newaxis])[0]
+    p = _transform(T1, im1_pts)
+    q = _transform(T2, im2_pts)
+    H_norm = np.dot(T2, np.dot(H, np.linalg.inv(T1)))
+    params = (H_norm / H_norm[2, 2]).ravel()[:8]
+
+    def residuals(params):
+        H_norm = np.append(params, 1).reshape((3, 3))
+        u = np.dot(p, H_norm[:, 0:2].T) + H_norm[:, 2]
+        return u[:, 0:2] / u[:, 2:3] - q, u[:, 2]
+
+    r, w = residuals(params)
+    error = np.sum(r ** 2)
+    damping = 1e-3
+    for _ in range(max_iter):
+        # Jacobian of the residuals of all points, of shape (n, 2, 8).
+        p_w = p / w[:, np.newaxis]
+        J = np.zeros((p.shape[0], 2, 8))
+        J[:, 0, 0:2] = p_w
+        J[:, 0, 2] = 1 / w
+        J[:, 1, 3:5] = p_w
+        J[:, 1, 5] = 1 / w
+        J[:, :, 6:8] = -(r + q)[:, :, np.newaxis] * p_w[:, np.newaxis, :]
+        JTJ = np.einsum("nij,nik->jk", J, J)
+        g = np.einsum("nij,ni->j", J, r)
+
+        # Increase the damping until the step reduces the error.
+        improved = False
+        while damping <= 1e10:
+            try:
+                step = np.linalg.solve(JTJ + damping * np.diag(np.diag(JTJ)),
+                    -g)
+            except np.linalg.LinAlgError:
+                damping *= 10
+                continue
+            r_new, w_new = residuals(params + step)
+            error_new = np.sum(r_new ** 2)
+            if error_new < error:
+                improved = True
+                break
+            damping *= 10
+        if not improved:
+            break
+        params = params + step
+        r, w = r_new, w_new
+        converged = error - error_new <= tol * error
+        error = error_new
+        damping /= 10
+        if converged:
+            break
+
+    H_norm = np.append(params, 1).reshape((3, 3))
+    H = np.dot(np.linalg.inv(T2), np.dot(H_norm, T1))
+    return H / H[2, 2]
+
+
+def _normalization(pts):
+    """
+    Similarity transformations moving the centroid of every point set to 0
+    and the mean distance to it to sqrt(2). Output shape: (K, 3, 3)
+    :param pts: Point sets of shape (K, n, 2).
+    """
+    centroid = np.mean(pts, axis = 1)
+    distance = np.mean(np.linalg.norm(pts - centroid[:, np.newaxis], axis = 2),
+        axis = 1)
+    scale = np.divide(np.sqrt(2), distance, out = np.ones_like(distance),
+        where = distance > 0)
+    T = np.zeros((pts.shape[0], 3, 3))
+    T[:, 0, 0] = T[:, 1, 1] = scale
+    T[:, 0:2, 2] = -scale[:, np.newaxis] * centroid
+    T[:, 2, 2] = 1
+    return T
+
+
+def _transform(T, pts):
+    """
+    Apply similarity transformations of shape (..., 3, 3) to points of shape
+    (..., n, 2).
+    """
+    return pts * T[..., np.newaxis, 0, 0:1] + T[..., np.newaxis, 0:2, 2]
@@ -1,16 +1,22 @@
+from functools import lru_cache
 import numpy as np
 from skimage.feature import corner_harris, peak_local_max
 import matplotlib.pyplot as plt
 import skimage.io as skio
 from skimage.transform import resize
+from skimage.util import img_as_float
+import scipy.ndimage as ndimage
 from harris import get_harris_corners
+from profiling import profiled, count
 
+@profiled("descriptors")
 def extract_descriptor(im, coords, patch_height = 40, patch_width = 40,
-    resize_ratio = 5):
+    resize_ratio = 5, method = "batch", mode = "float", num_bits = 256):
     """
     Extract feature descriptors from a image.
     Output shape: (num of feature points, patch_height // resize_ratio,
-    patch_width // resize_ratio)
+    patch_width // resize_ratio), or (num of feature points, num_bits // 8)
+    for binary descriptors.
     :param im: Input image.
     :param coords: Coordinates of feature points in the image.
     :param patch_height: Height of patch to extract feature descriptors
@@ -19,7 +25,51 @@ def extract_descriptor(im, coords, patch_height = 40, patch_width = 40,
         before subsampling.
     :resize_ratio: The ratio of subsampling. Final descriptor size will be
         (patch_height // resize_ratio, patch_width // resize_ratio).
+    :param method: "batch" blurs the image once and gathers all descriptors
+        in a single indexing operation. "resize" resizes each patch
+        separately.
+    :param mode: "float" gives normalized intensity descriptors. "binary"
+        gives BRIEF-style descriptors: num_bits intensity comparisons between
+        fixed pairs of pixels of the smoothed patch, packed into uint8.
+        match_feature compares those with the Hamming distance. "float16"
+        and "int8" give the float descriptors quantized to 2 and 1 bytes per
+        value (see _quantize), which match_feature compares directly.
+    :param num_bits: Number of comparisons of binary descriptors, a multiple
+        of 8.
+    Feature points whose patch does not fit in the image raise ValueError:
+    their patch would wrap around to the opposite border, or be truncated.
     """
+    count("descriptors", coords.shape[1])
+    # Check that every patch fits in the image.
+    low = np.array([[patch_height // 2], [patch_width // 2]])
+    high = np.array([[im.shape[0] - (patch_height - patch_height // 2)],
+        [im.shape[1] - (patch_width - patch_width // 2)]])
+    outside = np.any((coords < low) | (coords > high), axis = 0)
+    if np.any(outside):
+        raise ValueError(f"{np.count_nonzero(outside)} feature points are " +
+            "closer to the image border than half a patch, e.g. " +
+            f"{coords[:, np.argmax(outside)].tolist()}.")
+    if mode == "binary":
+        return _extract_descriptor_binary(im, coords, patch_height,
+            patch_width, resize_ratio, num_bits)
+    elif mode not in ("float", "float16", "int8"):
+        raise ValueError(f"Unknown descriptor mode: {mode}")
+    descriptors = _extract_descriptor_float(im, coords, patch_height,
+        patch_width, resize_ratio, method)
+    return descriptors if mode == "float" else _quantize(descriptors, mode)
+
+def _extract_descriptor_float(im, coords, patch_height, patch_width,
+    resize_ratio, method):
+    """
+    Extract normalized intensity descriptors with the given method, see
+    extract_descriptor.
+    """
+    if method == "batch":
+        return _extract_descriptor_batch(im, coords, patch_height, patch_width,
+            resize_ratio)
+    elif method != "resize":
+        raise ValueError(f"Unknown descriptor extraction method: {method}")
+
     # Create an empty list to contain all feature descriptors.
     list = []
 
@@ -40,9 +90,93 @@ def extract_descriptor(im, coords, patch_height = 40, patch_width = 40,
             sub_im = (sub_im - sub_im_avg) / sub_im_std
         list.append(sub_im)
     list = np.array(list)
-    print(list.shape)
     return list
 
+def _extract_descriptor_batch(im, coords, patch_height, patch_width,
+    resize_ratio):
+    """
+    Extract feature descriptors for all feature points at once. The image is
+    blurred once with the same anti-aliasing Gaussian that resize applies to
+    each patch, and the subsampled pixels of every patch are then gathered in
+    one fancy-indexing operation.
+    """
+    out_height = patch_height // resize_ratio
+    out_width = patch_width // resize_ratio
+    im_blur = _blur(im, resize_ratio)
+
+    # Sample at the center of each resize_ratio x resize_ratio block of the
+    # patch.
+    offset = (resize_ratio - 1) // 2
+    rr = coords[0][:, np.newaxis] - patch_height // 2 + offset + \
+        resize_ratio * np.arange(out_height)
+    cc = coords[1][:, np.newaxis] - patch_width // 2 + offset + \
+        resize_ratio * np.arange(out_width)
+    descriptors = im_blur[rr[:, :, np.newaxis], cc[:, np.newaxis, :]]
+
+    # Normalize every descriptor to have mean 0 and std 1.
+    descriptors_avg = np.mean(descriptors, axis = (1, 2), keepdims = True)
+    descriptors_std = np.std(descriptors, axis = (1, 2), keepdims = True)
+    descriptors = descriptors - descriptors_avg
+    np.divide(descriptors, descriptors_std, out = descriptors,
+        where = descriptors_std != 0)
+    return descriptors
+
+# Fixed scale of int8 descriptors, shared by all images so that their
+# distances are comparable. Normalized values beyond 127 / INT8_SCALE (about
+# 5.3 standard deviations, reached by under 1% of descriptors) are clipped.
+INT8_SCALE = 24
+
+
+def _quantize(descriptors, mode):
+    """
+    Quantize normalized descriptors to float16, or to int8 with the fixed
+    scale INT8_SCALE.
+    """
+    if mode == "float16":
+        return descriptors.astype(np.float16)
+    return np.clip(np.rint(descriptors * INT8_SCALE), -127, 127).astype(
+        np.int8)
+
+def _extract_descriptor_binary(im, coords, patch_height, patch_width,
+    resize_ratio, num_bits):
+    """
+    Extract binary descriptors for all feature points at once. Each bit
+    compares the smoothed image at two fixed locations of the patch, and
+    the bits of a descriptor are packed into num_bits // 8 bytes.
+    """
+    if num_bits % 8 != 0:
+        raise ValueError("num_bits must be a multiple of 8")
+    im_blur = _blur(im, resize_ratio)
+    pairs = _brief_pairs(patch_height, patch_width, num_bits)
+    rr = coords[0][:, np.newaxis] - patch_height // 2
+    cc = coords[1][:, np.newaxis] - patch_width // 2
+    bits = im_blur[rr + pairs[0], cc + pairs[1]] < \
+        im_blur[rr + pairs[2], cc + pairs[3]]
+    return np.packbits(bits, axis = 1)
+
+@lru_cache(maxsize = None)
+def _brief_pairs(patch_height, patch_width, num_bits):
+    """
+    Pixel pairs compared by binary descriptors, as rows (r1, c1, r2, c2) of
+    patch coordinates. They are drawn once from an isotropic Gaussian around
+    the patch center with a fixed seed, so that descriptors computed in
+    different processes agree.
+    """
+    rng = np.random.default_rng(0)
+    center = np.array([patch_height // 2, patch_width // 2] * 2)[:, np.newaxis]
+    scale = np.array([patch_height, patch_width] * 2)[:, np.newaxis] / 5
+    pairs = np.rint(center + scale * rng.standard_normal((4, num_bits)))
+    high = np.array([patch_height, patch_width] * 2)[:, np.newaxis] - 1
+    return np.clip(pairs, 0, high).astype(int)
+
+def _blur(im, resize_ratio):
+    """
+    Blur the image with the anti-aliasing Gaussian that resize applies when
+    subsampling by resize_ratio.
+    """
+    sigma = max(0, (resize_ratio - 1) / 2)
+    return ndimage.gaussian_filter(img_as_float(im), sigma)
+
 if __name__ == "__main__":
     # Compute feature descriptors of "mosaic3_left.jpeg". Sanity check. 
     im = skio.imread("mosaic3_left.jpeg")
@@ -0,0 +1,69 @@
+import numpy as np
+import scipy.spatial as spatial
+
+
+class DescriptorIndex:
+    """
+    Approximate nearest-neighbor index over the feature descriptors of one
+    image. Descriptors are projected onto their leading principal components
+    and stored in a KD-tree. Build the index once per image and pass it to
+    match_feature for every image it is matched against.
+    """
+
+    def __init__(self, descriptor, num_components = 8, num_candidates = 8,
+        eps = 1):
+        """
+        :param descriptor: Feature descriptors of the image, of shape
+            (num of feature points, ...).
+        :param num_components: Number of principal components kept. Fewer
+            components make queries faster but less accurate.
+        :param num_candidates: Number of nearest neighbors retrieved from the
+            KD-tree and re-ranked with the full descriptors. More candidates
+            give better recall at the cost of speed.
+        :param eps: Approximation factor of the KD-tree search. Returned
+            neighbors are at most (1 + eps) times farther than the true ones.
+        """
+        self.descriptor = descriptor.reshape(descriptor.shape[0], -1)
+        self.num_candidates = num_candidates
+        self.eps = eps
+        self.mean = np.mean(self.descriptor, axis = 0, dtype = np.float64)
+        _, _, vt = np.linalg.svd(self.descriptor - self.mean,
+            full_matrices = False)
+        self.components = vt[:num_components]
+        self.tree = spatial.cKDTree(self.project(self.descriptor))
+
+    def __len__(self):
+        return self.descriptor.shape[0]
+
+    def project(self, descriptor):
+        """
+        Project flattened descriptors onto the principal components.
+        :param descriptor: Descriptors of shape (num of feature points, D).
+        """
+        return np.dot(descriptor - self.mean, self.components.T)
+
+    def query(self, descriptor, k = 2):
+        """
+        Find the k nearest indexed descriptors of each query descriptor.
+        Returns the indices and squared distances of the neighbors, both of
+        shape (num of queries, k), sorted from nearest to farthest.
+        :param descriptor: Query descriptors, of shape
+            (num of feature points, ...).
+        :param k: Number of neighbors to return.
+        """
+        descriptor = descriptor.reshape(descriptor.shape[0], -1)
+        num_candidates = min(max(k, self.num_candidates), len(self))
+        _, candidates = self.tree.query(self.project(descriptor),
+            k = num_candidates, eps = self.eps)
+        candidates = candidates.reshape((descriptor.shape[0], -1))
+
+        # Re-rank the candidates with the full descriptors, in float64 so
+        # that quantized descriptors neither overflow nor lose precision.
+        descriptor = descriptor.astype(np.float64)
+        dist = np.empty(candidates.shape)
+        for j in range(num_candidates):
+            dist[:, j] = np.sum((descriptor -
+                self.descriptor[candidates[:, j]]) ** 2, axis = 1)
+        order = np.argsort(dist, axis = 1)[:, :k]
+        return np.take_along_axis(candidates, order, axis = 1), \
+            np.take_along_axis(dist, order, axis = 1)
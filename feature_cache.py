@@ -0,0 +1,160 @@
+import hashlib
+import inspect
+import os
+import tempfile
+import zipfile
+import numpy as np
+
+# Version of the format of the cache entries, part of every key. Bump it
+# when the stored arrays or the code of the cached stages change, so that
+# older entries are no longer used.
+FORMAT_VERSION = 2
+
+
+class FeatureCache:
+    """
+    Content-addressed on-disk cache of feature detection results. Entries
+    are keyed by a hash of the image content and of the stage parameters,
+    stored as compressed .npz files, and evicted least recently used first
+    once the cache grows beyond max_bytes. Hits and misses are counted.
+    """
+
+    def __init__(self, directory, max_bytes = 2 ** 30):
+        """
+        :param directory: Directory holding the cache entries. Created if it
+            does not exist.
+        :param max_bytes: Maximum total size in bytes of the cache entries.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok = True)
+
+    def key(self, im, **params):
+        """
+        Compute the cache key of an image and stage parameters.
+        :param im: Input image, or path of the image file. Files are hashed
+            by their bytes, arrays by their shape, data type and pixels.
+        :param params: Parameters of the cached stages, including the
+            defaults of the ones not set explicitly (see default_params).
+        """
+        digest = hashlib.sha256()
+        digest.update(f"v{FORMAT_VERSION}".encode())
+        if isinstance(im, str):
+            with open(im, "rb") as file:
+                for chunk in iter(lambda: file.read(2 ** 20), b""):
+                    digest.update(chunk)
+        else:
+            im = np.ascontiguousarray(im)
+            digest.update(repr((im.shape, im.dtype.str)).encode())
+            digest.update(im.data)
+        digest.update(repr(sorted(params.items())).encode())
+        return digest.hexdigest()
+
+    def get(self, key, names = None):
+        """
+        Look up an entry. Returns a dictionary of its arrays, or None on a
+        miss.
+        :param key: Key of the entry.
+        :param names: Optional names of the arrays the entry must hold. An
+            entry missing any of them is a miss.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in
+                    (data.files if names is None else names)}
+            # Mark the entry as recently used.
+            os.utime(path)
+        except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile):
+            # Missing, truncated or corrupted entries are misses.
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arrays
+
+    def put(self, key, **arrays):
+        """
+        Store arrays under key, then evict old entries if the cache is too
+        large.
+        """
+        path = self._path(key)
+        # Write to a uniquely named temporary file first so that readers
+        # never see a partial entry, and concurrent writers of the same key,
+        # in other threads or processes, do not share a file.
+        handle, temp_path = tempfile.mkstemp(dir = self.directory,
+            prefix = key + ".", suffix = ".tmp")
+        try:
+            with os.fdopen(handle, "wb") as file:
+                np.savez_compressed(file, **arrays)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self._evict(keep = path)
+
+    def stats(self):
+        """
+        Return the numbers of hits, misses and evictions, and the current
+        size in bytes of the cache.
+        """
+        return {"hits": self.hits, "misses": self.misses,
+            "evictions": self.evictions,
+            "size": sum(size for _, size, _ in self._entries())}
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def _entries(self):
+        """
+        List (last use time, size, path) of all entries.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict(self, keep = None):
+        """
+        Remove the least recently used entries until the cache fits in
+        max_bytes.
+        :param keep: Path of an entry that is never removed, such as the one
+            just written; its mtime may be older than that of other entries
+            on coarse-grained file systems.
+        """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+
+
+def default_params(*functions):
+    """
+    Collect the default parameters of the functions of the cached stages,
+    to key the cache on the ones the caller does not set. Returns a
+    dictionary of the defaults of every function, by function name.
+    :param functions: Functions of the cached stages.
+    """
+    return {function.__name__: {name: param.default for name, param in
+        inspect.signature(function).parameters.items()
+        if param.default is not inspect.Parameter.empty}
+        for function in functions}
@@ -6,9 +6,16 @@ from skimage.transform import resize
 from harris import get_harris_corners
 from harris import dist2
 from descriptor_extraction import extract_descriptor
+from profiling import profiled, count
 
+# Default ratio thresholds of match_feature, for float (also float16 and
+# int8) descriptors and for binary descriptors, whose Hamming distances
+# spread less than squared Euclidean ones.
+MATCH_THRESHOLDS = {"float": 0.27, "binary": 0.6}
 
-def match_feature(im1_descriptor, im2_descriptor, im1_coords, im2_coords, threshold):
+@profiled("matching")
+def match_feature(im1_descriptor, im2_descriptor, im1_coords, im2_coords,
+    threshold, memory_budget = 2 ** 27, index = None, return_scores = False):
     """
     Match feature points in image 1 with points in image 2. Manage to only
     preserve valid matchings.
@@ -19,6 +26,20 @@ def match_feature(im1_descriptor, im2_descriptor, im1_coords, im2_coords, thresh
     :threshold: constraint on valid feature matchings. A matching is considered
         valid if and only if
         diff(best match) / diff(second best match) < threshold.
+    :param memory_budget: Maximum size in bytes of the block of descriptor
+        distances held in memory at once. Descriptors of image 1 are matched
+        in chunks that fit in this budget.
+    :param index: Optional DescriptorIndex built over im2_descriptor. If
+        given, the nearest neighbors are looked up in the index instead of
+        being searched exhaustively.
+    :param return_scores: If True, also return the ratio
+        diff(best match) / diff(second best match) of every valid matching,
+        which can be passed to ransac as scores.
+    Binary descriptors (uint8, see extract_descriptor) are compared with the
+    Hamming distance, which is the squared Euclidean distance between their
+    bits, so the same ratio test applies. Quantized float16 and int8
+    descriptors stay in their stored type: only blocks of them are converted
+    to float32 for the distance products, which is exact for int8.
     """
     # Handle inputs. If input is a 3-D vector, flatten the 2-D descriptor for
     # each feature point.
@@ -32,23 +53,331 @@ def match_feature(im1_descriptor, im2_descriptor, im1_coords, im2_coords, thresh
     else:
         im2_descriptor_flatten = im2_descriptor.reshape(im2_descriptor.shape[0], -1)
 
-    # Compute feature descriptor correlations between each feature point in
-    # image 1 and each point in image 2.
-    correlation = dist2(im1_descriptor_flatten, im2_descriptor_flatten)
+    # The ratio test needs a best and a second best match.
+    if im2_descriptor_flatten.shape[0] < 2:
+        if return_scores:
+            return im1_coords[:, :0], im2_coords[:, :0], np.zeros(0)
+        return im1_coords[:, :0], im2_coords[:, :0]
 
-    # Find the ratio between difference of best match and second best match for
-    # each feature point in image 1.
-    min_correlation_row = np.min(correlation, axis = 1)
-    correlation_ratio = \
-        min_correlation_row.reshape((len(min_correlation_row), 1)) / correlation
-    correlation_sort = np.argsort(correlation_ratio, axis = 1)
-    nn1_index = correlation_sort[:, -1]
-    nn2_index = correlation_sort[:, -2]
-    nn2_ratio = correlation_ratio[list(range(correlation.shape[0])), nn2_index]
+    # Find the best and second best match in image 2 for each feature point in
+    # image 1, and the ratio between their differences.
+    if im1_descriptor_flatten.dtype == np.uint8:
+        if index is not None:
+            raise ValueError("DescriptorIndex does not support binary "
+                "descriptors")
+        nn1_index, nn2_index, nn1_dist, nn2_dist = _nearest_two_hamming(
+            im1_descriptor_flatten, im2_descriptor_flatten, memory_budget)
+        return _ratio_test(im1_coords, im2_coords, nn1_index, nn1_dist,
+            nn2_dist, threshold, return_scores)
+    if index is None:
+        nn1_index, nn2_index = _nearest_two(im1_descriptor_flatten,
+            im2_descriptor_flatten, memory_budget)
+    else:
+        nn_index, _ = index.query(im1_descriptor_flatten, k = 2)
+        nn1_index, nn2_index = nn_index[:, 0], nn_index[:, 1]
+    im1_pts = np.arange(im1_descriptor_flatten.shape[0])
+    nn1_dist = pair_distances(im1_descriptor_flatten,
+        im2_descriptor_flatten, im1_pts, nn1_index, memory_budget)
+    nn2_dist = pair_distances(im1_descriptor_flatten,
+        im2_descriptor_flatten, im1_pts, nn2_index, memory_budget)
+    # Selection may be done in float32 or approximately; make sure the exact
+    # distances agree with the order of the two matches.
+    swap = nn2_dist < nn1_dist
+    nn1_index[swap], nn2_index[swap] = nn2_index[swap], nn1_index[swap]
+    nn1_dist[swap], nn2_dist[swap] = nn2_dist[swap], nn1_dist[swap]
+    return _ratio_test(im1_coords, im2_coords, nn1_index, nn1_dist, nn2_dist,
+        threshold, return_scores)
+
+
+@profiled("matching")
+def match_feature_guided(im1_descriptor, im2_descriptor, im1_coords,
+    im2_coords, H, threshold, radius = 8, cell_size = None,
+    memory_budget = 2 ** 27, return_scores = False):
+    """
+    Match feature points in image 1 with points in image 2, guided by an
+    estimate of the projective transformation between the images. Each
+    feature point of image 1 is transformed by H, and its descriptor is only
+    compared with those of the points of image 2 within radius pixels of the
+    prediction, found in a uniform grid over image 2. This takes roughly
+    O(N k) time for N points of image 1 with k candidates each, instead of
+    the O(N M) of match_feature, so many more feature points can be matched.
+    :param im1_descriptor: Feature descriptors of image 1.
+    :param im2_descriptor: Feature descriptors of image 2.
+    :param im1_coords: Feature point locations in image 1.
+    :param im2_coords: Feature point locations in image 2.
+    :param H: Projective transformation matrix from image 1 to image 2, e.g.
+        estimated by ransac.
+    :param threshold: constraint on valid feature matchings, as in
+        match_feature, among the candidates of each point. A point with a
+        single candidate is matched to it.
+    :param radius: Search radius in pixels around predicted locations.
+    :param cell_size: Size in pixels of the cells of the grid. Defaults to
+        radius.
+    :param memory_budget: Maximum size in bytes of the block of candidate
+        descriptors held in memory at once.
+    :param return_scores: If True, also return the ratio of every valid
+        matching, as in match_feature.
+    """
+    im1_descriptor_flatten = im1_descriptor.reshape(im1_descriptor.shape[0],
+        -1)
+    im2_descriptor_flatten = im2_descriptor.reshape(im2_descriptor.shape[0],
+        -1)
+    cell_size = radius if cell_size is None else cell_size
+
+    # Predicted location of every feature point of image 1 in image 2.
+    predicted = np.dot(H, np.concatenate((im1_coords,
+        np.ones((1, im1_coords.shape[1])))))
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        predicted = predicted[:2] / predicted[2]
+
+    # Candidate pairs of a point of image 1 and a point of image 2 within
+    # radius of its prediction.
+    im1_pts, im2_pts = _grid_candidates(predicted, im2_coords, radius,
+        cell_size)
+    count("candidates", len(im1_pts))
+    if len(im1_pts) == 0:
+        if return_scores:
+            return im1_coords[:, :0], im2_coords[:, :0], np.zeros(0)
+        return im1_coords[:, :0], im2_coords[:, :0]
+
+    # Descriptor distance of every candidate pair.
+    dist = pair_distances(im1_descriptor_flatten, im2_descriptor_flatten,
+        im1_pts, im2_pts, memory_budget)
+
+    # Best and second best candidate of every point of image 1 that has any.
+    order = np.lexsort((dist, im1_pts))
+    im1_pts, im2_pts, dist = im1_pts[order], im2_pts[order], dist[order]
+    first = np.flatnonzero(np.r_[True, im1_pts[1:] != im1_pts[:-1]])
+    has_second = np.r_[first[1:], len(im1_pts)] - first > 1
+    nn2_dist = np.full(len(first), np.inf)
+    nn2_dist[has_second] = dist[first[has_second] + 1]
+    return _ratio_test(im1_coords[:, im1_pts[first]], im2_coords,
+        im2_pts[first], dist[first], nn2_dist, threshold, return_scores)
+
+
+def _grid_candidates(predicted, coords, radius, cell_size):
+    """
+    Find all pairs (i, j) such that point j of coords lies within radius of
+    predicted point i. The points of coords are binned into a uniform grid
+    of cell_size, stored as the point indices sorted by cell and the start
+    of every cell, and each predicted point only visits the cells its
+    search window overlaps. Returns the arrays of i and j.
+    """
+    # Cell of every point, and the points of every cell.
+    origin = np.min(coords, axis = 1, keepdims = True) if \
+        coords.shape[1] > 0 else np.zeros((2, 1))
+    cells = np.floor((coords - origin) / cell_size).astype(np.intp)
+    num_cells = np.max(cells, axis = 1) + 1 if coords.shape[1] > 0 else \
+        np.zeros(2, dtype = np.intp)
+    cell_index = cells[0] * num_cells[1] + cells[1]
+    sort_indices = np.argsort(cell_index, kind = "stable")
+    cell_start = np.searchsorted(cell_index[sort_indices],
+        np.arange(num_cells[0] * num_cells[1] + 1))
+
+    # Range of cells overlapped by the search window of every prediction.
+    # Predictions with windows outside of the grid have no candidates.
+    valid = np.all(np.isfinite(predicted), axis = 0)
+    predicted = np.where(valid, predicted, 0)
+    low = np.floor((predicted - radius - origin) / cell_size)
+    high = np.floor((predicted + radius - origin) / cell_size)
+    low = np.maximum(low, 0).astype(np.intp)
+    high = np.minimum(high, num_cells[:, np.newaxis] - 1).astype(np.intp)
+    valid &= np.all(low <= high, axis = 0)
+
+    # Visit the cells of the windows one offset at a time.
+    span = int(np.ceil(2 * radius / cell_size)) + 1
+    pts, visited = [], []
+    for dr in range(span):
+        for dc in range(span):
+            in_window = valid & (low[0] + dr <= high[0]) & \
+                (low[1] + dc <= high[1])
+            pts.append(np.flatnonzero(in_window))
+            visited.append((low[0, in_window] + dr) * num_cells[1] +
+                low[1, in_window] + dc)
+    pts, visited = np.concatenate(pts), np.concatenate(visited)
+
+    # Expand every visited cell into its points.
+    sizes = cell_start[visited + 1] - cell_start[visited]
+    im1_pts = np.repeat(pts, sizes)
+    within = np.arange(len(im1_pts)) - np.repeat(np.cumsum(sizes) - sizes,
+        sizes)
+    im2_pts = sort_indices[np.repeat(cell_start[visited], sizes) + within]
+
+    # Keep the candidates within radius of their prediction.
+    keep = np.sum((coords[:, im2_pts] - predicted[:, im1_pts]) ** 2,
+        axis = 0) <= radius ** 2
+    return im1_pts[keep], im2_pts[keep]
+
+
+def default_threshold(descriptor):
+    """
+    Default ratio threshold of match_feature for descriptors of this type
+    (see MATCH_THRESHOLDS).
+    :param descriptor: Feature descriptors, as returned by
+        extract_descriptor.
+    """
+    return MATCH_THRESHOLDS["binary" if descriptor.dtype == np.uint8 else
+        "float"]
+
+
+def pair_distances(x, c, x_index, c_index, memory_budget = 2 ** 27):
+    """
+    Exact squared distances between the rows x[x_index] and c[c_index] (in
+    float64, whatever the stored type), or Hamming distances for bit-packed
+    uint8 descriptors.
+    :param x: Flattened descriptors, one per row.
+    :param c: Flattened descriptors of the same type, one per row.
+    :param x_index: Rows of x of every pair.
+    :param c_index: Rows of c of every pair.
+    :param memory_budget: Maximum size in bytes of the chunk of pairs held
+        in memory at once.
+    """
+    binary = x.dtype == np.uint8
+    if binary and hasattr(np, "bitwise_count") and x.shape[1] % 8 == 0:
+        x = np.ascontiguousarray(x).view(np.uint64)
+        c = np.ascontiguousarray(c).view(np.uint64)
+    chunk_size = max(1, int(memory_budget // (2 * 8 * x.shape[1])))
+    dist = np.empty(len(x_index))
+    for start in range(0, len(x_index), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        x_chunk = x[x_index[chunk]]
+        c_chunk = c[c_index[chunk]]
+        if binary:
+            dist[chunk] = np.sum(_popcount(x_chunk ^ c_chunk), axis = 1)
+        else:
+            dist[chunk] = np.sum((x_chunk.astype(np.float64) - c_chunk) ** 2,
+                axis = 1)
+    return dist
+
+
+def _ratio_test(im1_coords, im2_coords, nn1_index, nn1_dist, nn2_dist,
+    threshold, return_scores):
+    """
+    Keep the matchings whose best match is clearly better than the second
+    best one.
+    """
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        nn2_ratio = nn1_dist / nn2_dist
 
     # Filter out the points whose best match and second best match are too
     # similar, since this indicates that there is likely to be no valid matching.
     mask = nn2_ratio < threshold
-    im1_pts = np.arange(correlation.shape[0])[mask]
+    count("matches", np.count_nonzero(mask))
+    im1_pts = np.arange(nn1_index.shape[0])[mask]
     im2_pts = nn1_index[mask]
+    if return_scores:
+        return im1_coords[:, im1_pts], im2_coords[:, im2_pts], nn2_ratio[mask]
     return im1_coords[:, im1_pts], im2_coords[:, im2_pts]
+
+
+def _nearest_two(x, c, memory_budget, block_size = 8192):
+    """
+    Find the indices of the two rows of c closest to each row of x. The
+    descriptors stay in their stored type (e.g. float16 or int8): blocks of
+    block_size rows of c and chunks of rows of x are converted to float32
+    for the matrix product, and the float32 block of squared distances
+    between a chunk and a block stays within memory_budget bytes. Products
+    of int8 descriptors are exact in float32.
+    """
+    block_size = min(block_size, c.shape[0])
+    chunk_size = max(1, int(memory_budget // (4 * block_size)))
+
+    nn1_index = np.zeros(x.shape[0], dtype = np.intp)
+    nn2_index = np.zeros(x.shape[0], dtype = np.intp)
+    nn1_dist = np.full(x.shape[0], np.inf, dtype = np.float32)
+    nn2_dist = np.full(x.shape[0], np.inf, dtype = np.float32)
+    for block_start in range(0, c.shape[0], block_size):
+        c_block = c[block_start: block_start + block_size].astype(np.float32)
+        c_sq = np.sum(c_block ** 2, axis = 1)
+        for start in range(0, x.shape[0], chunk_size):
+            chunk = slice(start, start + chunk_size)
+            x_chunk = x[chunk].astype(np.float32)
+            rows = np.arange(x_chunk.shape[0])
+            # Squared distances, computed in place in a single block.
+            dist = np.dot(x_chunk, c_block.T)
+            dist *= -2
+            dist += c_sq
+            dist += np.sum(x_chunk ** 2, axis = 1)[:, np.newaxis]
+            # Partial selection of the two smallest distances in each row.
+            nn1 = np.argmin(dist, axis = 1)
+            dist1 = dist[rows, nn1]
+            dist[rows, nn1] = np.inf
+            nn2 = np.argmin(dist, axis = 1)
+            dist2 = dist[rows, nn2]
+            # Merge them with the two nearest rows of the previous blocks.
+            first = dist1 < nn1_dist[chunk]
+            second = np.where(first, np.minimum(nn1_dist[chunk], dist2),
+                np.minimum(nn2_dist[chunk], dist1))
+            nn2_index[chunk] = np.where(first, np.where(nn1_dist[chunk] <=
+                dist2, nn1_index[chunk], nn2 + block_start),
+                np.where(nn2_dist[chunk] <= dist1, nn2_index[chunk],
+                nn1 + block_start))
+            nn2_dist[chunk] = second
+            nn1_index[chunk] = np.where(first, nn1 + block_start,
+                nn1_index[chunk])
+            nn1_dist[chunk] = np.where(first, dist1, nn1_dist[chunk])
+    return nn1_index, nn2_index
+
+
+def _nearest_two_hamming(x, c, memory_budget, block_size = 2 ** 20):
+    """
+    Find the indices of, and Hamming distances to, the two rows of c closest
+    to each row of x, for bit-packed uint8 descriptors. Rows of x are
+    processed in small blocks so that the XORed words of a block and c stay
+    within block_size bytes (and within memory_budget).
+    """
+    # XOR and count bits one word of all descriptors at a time, 8 bytes per
+    # word when NumPy has bitwise_count and the descriptors allow it.
+    if hasattr(np, "bitwise_count") and x.shape[1] % 8 == 0:
+        x = np.ascontiguousarray(x).view(np.uint64)
+        c = np.ascontiguousarray(c).view(np.uint64)
+    c_words = np.ascontiguousarray(c.T)
+    dist_type = np.uint16 if 8 * c.itemsize * c.shape[1] < 2 ** 16 \
+        else np.int64
+    chunk_size = max(1, int(min(block_size, memory_budget) //
+        (c.itemsize * c.shape[0])))
+    chunk_size = min(chunk_size, x.shape[0])
+
+    # Buffers reused by every block.
+    xor = np.empty((chunk_size, c.shape[0]), dtype = c.dtype)
+    bits = np.empty((chunk_size, c.shape[0]), dtype = _popcount(c[:0]).dtype)
+    dist_buffer = np.empty((chunk_size, c.shape[0]), dtype = dist_type)
+
+    nn1_index = np.empty(x.shape[0], dtype = np.intp)
+    nn2_index = np.empty(x.shape[0], dtype = np.intp)
+    nn1_dist = np.empty(x.shape[0], dtype = np.int64)
+    nn2_dist = np.empty(x.shape[0], dtype = np.int64)
+    for start in range(0, x.shape[0], chunk_size):
+        x_chunk = x[start: start + chunk_size]
+        num_rows = x_chunk.shape[0]
+        rows = np.arange(num_rows)
+        dist = dist_buffer[:num_rows]
+        dist[...] = 0
+        for word in range(c.shape[1]):
+            np.bitwise_xor(x_chunk[:, word: word + 1], c_words[word],
+                out = xor[:num_rows])
+            _popcount(xor[:num_rows], out = bits[:num_rows])
+            np.add(dist, bits[:num_rows], out = dist)
+        nn1 = np.argmin(dist, axis = 1)
+        nn1_dist[start: start + chunk_size] = dist[rows, nn1]
+        dist[rows, nn1] = np.iinfo(dist_type).max
+        nn2 = np.argmin(dist, axis = 1)
+        nn2_dist[start: start + chunk_size] = dist[rows, nn2]
+        nn1_index[start: start + chunk_size] = nn1
+        nn2_index[start: start + chunk_size] = nn2
+    return nn1_index, nn2_index, nn1_dist, nn2_dist
+
+
+# Number of set bits of every byte value, for NumPy without bitwise_count.
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)],
+    dtype = np.uint8)
+
+
+def _popcount(x, out = None):
+    """
+    Number of set bits of every element of an unsigned integer array (of
+    uint8 when NumPy has no bitwise_count), optionally written to out.
+    """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x, out = out)
+    return np.take(_POPCOUNT_TABLE, x, out = out)
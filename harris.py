@@ -1,9 +1,17 @@
 import numpy as np
+import scipy.ndimage as ndimage
+import scipy.spatial as spatial
+from concurrent.futures import ThreadPoolExecutor
 from skimage.feature import corner_harris, peak_local_max
+from skimage.util import img_as_float
 import matplotlib.pyplot as plt
 import skimage.io as skio
+from profiling import profiled, count
 
-def get_harris_corners(im, edge_discard=20, min_distance = 1):
+@profiled("harris")
+def get_harris_corners(im, edge_discard=20, min_distance = 1, sigma = 1,
+    tile_size = None, max_workers = None, dtype = None, grid = None,
+    max_per_cell = None, max_corners = None):
     """
     This function takes a b&w image and an optional amount to discard
     on the edge (default is 5 pixels), and finds all harris corners
@@ -13,24 +21,155 @@ def get_harris_corners(im, edge_discard=20, min_distance = 1):
 
     h is the same shape as the original image, im.
     coords is 2 x n (ys, xs).
+
+    :param sigma: standard deviation of the Gaussian window of the
+        structure tensor.
+    :param tile_size: if given, the response and its local maxima are
+        computed on square tiles of this size in a thread pool, so that
+        the filter intermediates are only ever tile-sized. The result is
+        identical to the whole-image computation.
+    :param max_workers: number of threads used for the tiles.
+    :param dtype: floating point type of the response, e.g. np.float32 to
+        halve its memory. Defaults to float64.
+    :param grid: (rows, cols) of a grid of cells over the image. Together
+        with max_per_cell, only the max_per_cell strongest corners of
+        every cell are kept.
+    :param max_per_cell: maximum number of corners kept per grid cell.
+    :param max_corners: maximum number of corners kept overall (the
+        strongest ones). With the cell budget, this bounds the number of
+        points handed to the later stages regardless of scene texture.
     """
 
     assert edge_discard >= 20
 
-    # find harris corners
-    h = corner_harris(im, method='eps', sigma=1)
-    coords = peak_local_max(h, min_distance = min_distance, indices=True)
+    if tile_size is None:
+        # find harris corners
+        if dtype is not None:
+            im = img_as_float(im).astype(dtype, copy = False)
+        h = corner_harris(im, method='eps', sigma=sigma)
+        coords = peak_local_max(h, min_distance = min_distance)
+    else:
+        h, coords = _harris_tiled(im, min_distance, sigma, tile_size,
+            max_workers, dtype)
+    count("raw_corners", coords.shape[0])
     # discard points on edge
     edge = edge_discard  # pixels
     mask = (coords[:, 0] > edge) & \
            (coords[:, 0] < im.shape[0] - edge) & \
            (coords[:, 1] > edge) & \
            (coords[:, 1] < im.shape[1] - edge)
-    # print(coords)
     coords = coords[mask].T
+    coords = _bucket_corners(h, coords, grid, max_per_cell, max_corners)
+    count("corners", coords.shape[1])
     return h, coords
 
 
+def _bucket_corners(h, coords, grid, max_per_cell, max_corners):
+    """
+    Keeps the max_per_cell strongest corners of every cell of a grid over
+    h, then the max_corners strongest of those. Corners keep their
+    original order.
+    """
+
+    strength = h[coords[0], coords[1]]
+    keep = np.arange(coords.shape[1])
+    if grid is not None and max_per_cell is not None:
+        grid_rows, grid_cols = grid
+        cell = (coords[0] * grid_rows // h.shape[0]) * grid_cols + \
+               coords[1] * grid_cols // h.shape[1]
+        # group the corners by cell, strongest first, and rank them in it
+        order = np.lexsort((-strength, cell))
+        cell = cell[order]
+        start = np.searchsorted(cell, cell)
+        rank = np.arange(len(cell)) - start
+        keep = np.sort(order[rank < max_per_cell])
+    if max_corners is not None and len(keep) > max_corners:
+        best = np.argpartition(-strength[keep], max_corners - 1)[:max_corners]
+        keep = np.sort(keep[best])
+    return coords[:, keep]
+
+
+def _harris_tiled(im, min_distance, sigma, tile_size, max_workers, dtype):
+    """
+    Tiled, multithreaded equivalent of corner_harris followed by
+    peak_local_max. Returns the full response and the (n, 2) peak
+    coordinates in the order peak_local_max would give them.
+    """
+
+    height, width = im.shape
+    dtype = np.float64 if dtype is None else dtype
+    h = np.empty((height, width), dtype = dtype)
+    # the Sobel derivatives reach 1 pixel and the Gaussian window
+    # int(4 * sigma + 0.5) pixels (skimage truncates at 4 sigma)
+    halo = 1 + int(4 * sigma + 0.5)
+    tiles = [(r, c, min(r + tile_size, height), min(c + tile_size, width))
+        for r in range(0, height, tile_size)
+        for c in range(0, width, tile_size)]
+
+    def response(tile):
+        r0, c0, r1, c1 = tile
+        rr0, cc0 = max(r0 - halo, 0), max(c0 - halo, 0)
+        rr1, cc1 = min(r1 + halo, height), min(c1 + halo, width)
+        block = img_as_float(im[rr0:rr1, cc0:cc1]).astype(dtype, copy = False)
+        block_h = corner_harris(block, method='eps', sigma=sigma)
+        h[r0:r1, c0:c1] = block_h[r0 - rr0:r1 - rr0, c0 - cc0:c1 - cc0]
+
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        list(executor.map(response, tiles))
+
+        # peak_local_max thresholds at the global minimum of the response
+        # and finds nothing at all on a constant response
+        threshold = h.min()
+        if threshold == h.max():
+            return h, np.empty((0, 2), dtype = np.intp)
+        size = 2 * min_distance + 1
+
+        def peaks(tile):
+            r0, c0, r1, c1 = tile
+            rr0, cc0 = max(r0 - min_distance, 0), max(c0 - min_distance, 0)
+            rr1 = min(r1 + min_distance, height)
+            cc1 = min(c1 + min_distance, width)
+            block = h[rr0:rr1, cc0:cc1]
+            block_max = ndimage.maximum_filter(block, size = size,
+                mode = 'nearest')
+            block = block[r0 - rr0:r1 - rr0, c0 - cc0:c1 - cc0]
+            block_max = block_max[r0 - rr0:r1 - rr0, c0 - cc0:c1 - cc0]
+            rows, cols = np.nonzero((block == block_max) & (block > threshold))
+            return rows + r0, cols + c0
+
+        results = list(executor.map(peaks, tiles))
+
+    rows = np.concatenate([rows for rows, _ in results])
+    cols = np.concatenate([cols for _, cols in results])
+    # peak_local_max excludes a border of min_distance pixels
+    mask = (rows >= min_distance) & (rows < height - min_distance) & \
+           (cols >= min_distance) & (cols < width - min_distance)
+    rows, cols = rows[mask], cols[mask]
+    # strongest first, ties in raster order
+    order = np.lexsort((cols, rows, -h[rows, cols]))
+    coords = np.stack((rows[order], cols[order]), axis = 1)
+    if min_distance > 1:
+        coords = _ensure_spacing(coords, min_distance)
+    return h, coords
+
+
+def _ensure_spacing(coords, spacing):
+    """
+    Greedily keeps coords (sorted strongest first) that are at least
+    spacing away, in Chebyshev distance, from every stronger kept point.
+    """
+
+    tree = spatial.cKDTree(coords)
+    # coords are integers, so a distance below spacing is at most spacing - 1
+    neighbors = tree.query_ball_point(coords, r = spacing - 1, p = np.inf)
+    keep = np.ones(len(coords), dtype = bool)
+    for i, candidates in enumerate(neighbors):
+        if keep[i]:
+            keep[candidates] = False
+            keep[i] = True
+    return coords[keep]
+
+
 def dist2(x, c):
     """
     dist2  Calculates squared distance between two sets of points.
@@ -9,6 +9,7 @@ import scipy.interpolate as interpolate
 from compute_projection import computeH
 from define_features import get_points
 from warp_image import warpImage
+from composite import composite
 
 
 # left_im = skio.imread("left.jpeg")
@@ -113,29 +114,20 @@ else:
     left_im_pts = get_points(left_im, 8)
     right_im_pts = get_points(right_im, 8)
 
-result = np.zeros((left_im.shape[0], 373 + left_im.shape[1], 3))
 H = computeH(left_im_pts, right_im_pts)
-output = warpImage(right_im, H, [left_im.shape[0], left_im.shape[1] + 373])
 
 # Generate feathered result.
-result[:, :680] = left_im[:, :680]
-result[:, 700:] = output[:, 700:]
-# Create an alpha mask around the boundary to do image feathering.
-alpha_mask = np.tile(np.linspace(0, 1, 20, endpoint = True),
-    (left_im.shape[0], 1))
-alpha_mask = np.dstack([alpha_mask, alpha_mask, alpha_mask])
-result[:, 680:700] = alpha_mask * output[:, 680:700] + \
-    (1 - alpha_mask) * left_im[:, 680:700]
-skio.imshow(result / 255)
+result, _ = composite([left_im, right_im], [np.eye(3), H])
+skio.imshow(result)
 skio.show()
-skio.imsave("mosaic3_masked.jpeg", result / 255)
+skio.imsave("mosaic3_masked.jpeg", result)
 
 # Generate unfeathered result.
-unmasked_result = np.array(output)
-unmasked_result[:, :700] = left_im[:, :700]
-skio.imshow(unmasked_result / 255)
+unmasked_result, _ = composite([left_im, right_im], [np.eye(3), H],
+    blend = "none")
+skio.imshow(unmasked_result)
 skio.show()
-skio.imsave("mosaic3_unmasked.jpeg", unmasked_result / 255)
+skio.imsave("mosaic3_unmasked.jpeg", unmasked_result)
 
 if use_features == "N":
     print("Third Mosaic: Save image features or not? [Y/N]")
@@ -156,29 +148,20 @@ else:
     left_im_pts = get_points(left_im, 8)
     right_im_pts = get_points(right_im, 8)
 
-result = np.zeros((left_im.shape[0], right_im.shape[1] + left_im.shape[1], 3))
 H = computeH(left_im_pts, right_im_pts)
-output = warpImage(right_im, H, [left_im.shape[0], left_im.shape[1] + right_im.shape[1]])
 
 # Generate feathered result.
-result[:, :680] = left_im[:, :680]
-result[:, 700:] = output[:, 700:]
-# Create an alpha mask around the boundary to do image feathering.
-alpha_mask = np.tile(np.linspace(0, 1, 20, endpoint = True),
-    (left_im.shape[0], 1))
-alpha_mask = np.dstack([alpha_mask, alpha_mask, alpha_mask])
-result[:, 680:700] = alpha_mask * output[:, 680:700] + \
-    (1 - alpha_mask) * left_im[:, 680:700]
-skio.imshow(result / 255)
+result, _ = composite([left_im, right_im], [np.eye(3), H])
+skio.imshow(result)
 skio.show()
-skio.imsave("mosaic4_masked.jpeg", result / 255)
+skio.imsave("mosaic4_masked.jpeg", result)
 
 # Generate unfeathered result.
-unmasked_result = np.array(output)
-unmasked_result[:, :700] = left_im[:, :700]
-skio.imshow(unmasked_result / 255)
+unmasked_result, _ = composite([left_im, right_im], [np.eye(3), H],
+    blend = "none")
+skio.imshow(unmasked_result)
 skio.show()
-skio.imsave("mosaic4_unmasked.jpeg", unmasked_result / 255)
+skio.imsave("mosaic4_unmasked.jpeg", unmasked_result)
 
 if use_features == "N":
     print("Fourth Mosaic: Save image features or not? [Y/N]")
@@ -199,29 +182,20 @@ else:
     left_im_pts = get_points(left_im, 8)
     right_im_pts = get_points(right_im, 8)
 
-result = np.zeros((left_im.shape[0], right_im.shape[1] + left_im.shape[1], 3))
 H = computeH(left_im_pts, right_im_pts)
-output = warpImage(right_im, H, [left_im.shape[0], left_im.shape[1] + right_im.shape[1]])
 
 # Generate feathered result.
-result[:, :680] = left_im[:, :680]
-result[:, 700:] = output[:, 700:]
-# Create an alpha mask around the boundary to do image feathering.
-alpha_mask = np.tile(np.linspace(0, 1, 20, endpoint = True),
-    (left_im.shape[0], 1))
-alpha_mask = np.dstack([alpha_mask, alpha_mask, alpha_mask])
-result[:, 680:700] = alpha_mask * output[:, 680:700] + \
-    (1 - alpha_mask) * left_im[:, 680:700]
-skio.imshow(result / 255)
+result, _ = composite([left_im, right_im], [np.eye(3), H])
+skio.imshow(result)
 skio.show()
-skio.imsave("mosaic7_masked.jpeg", result / 255)
+skio.imsave("mosaic7_masked.jpeg", result)
 
 # Generate unfeathered result.
-unmasked_result = np.array(output)
-unmasked_result[:, :700] = left_im[:, :700]
-skio.imshow(unmasked_result / 255)
+unmasked_result, _ = composite([left_im, right_im], [np.eye(3), H],
+    blend = "none")
+skio.imshow(unmasked_result)
 skio.show()
-skio.imsave("mosaic7_unmasked.jpeg", unmasked_result / 255)
+skio.imsave("mosaic7_unmasked.jpeg", unmasked_result)
 
 if use_features == "N":
     print("Fifth Mosaic: Save image features or not? [Y/N]")
@@ -3,36 +3,131 @@ from skimage.feature import corner_harris, peak_local_max
 import matplotlib.pyplot as plt
 import skimage.io as skio
 from skimage.transform import resize
+import scipy.spatial as spatial
 from harris import get_harris_corners
 from harris import dist2
 from descriptor_extraction import extract_descriptor
 from feature_matching import match_feature
 from compute_projection import computeH
 from ransac import ransac
+from profiling import profiled, count
 
 
-def non_max_suppression(h, coords, max_pts = 500, c_robust = 0.9):
+@profiled("anms")
+def non_max_suppression(h, coords, max_pts = 500, c_robust = 0.9,
+    method = "kdtree"):
     """
-    Use non-max suppression algorithm to pick the top few feature points.
+    Use adaptive non-max suppression (ANMS) to pick the top few feature points.
+    A point is suppressed by every point that is sufficiently stronger than it
+    (h_i < c_robust * h_j); its suppression radius is the distance to the
+    nearest such point, and the points with the largest radii are retained.
     :param h: Same size as the original image. Value at each point represents
         corner strength of that pixel.
     :param coords: pixel locations of coarse feature points.
     :param max_pts: Number of feature points to retain.
     :param c_robust: hyperparameter to suppress radius around a feature point.
+    :param method: "kdtree" processes points in descending strength order and
+        finds suppression radii with a KD-tree, in roughly O(N log N) time and
+        O(N) memory. "dense" builds the full N x N distance matrix, and is kept
+        for comparison.
     """
     coords_h = h[coords[0], coords[1]]
-    coords_dist = dist2(coords.T, coords.T)
-    ratio_matrix = np.outer(coords_h, (1 / coords_h))
-    mask = ratio_matrix < c_robust
-    coords_dist_masked = coords_dist * ratio_matrix
-    coords_dist_nonzero = np.where(coords_dist_masked == 0, coords_dist_masked,
-        np.inf)
-    suppress_radius = np.min(coords_dist_nonzero, axis = 1)
-    sort_indices = np.argsort(suppress_radius)
+    if method == "kdtree":
+        suppress_radius = _kdtree_suppress_radius(coords_h, coords, c_robust)
+    elif method == "dense":
+        suppress_radius = _dense_suppress_radius(coords_h, coords, c_robust)
+    else:
+        raise ValueError(f"Unknown non-max suppression method: {method}")
+
+    # Retain the points with the largest suppression radii. Ties (e.g. the
+    # unsuppressed points, whose radius is infinite) go to the stronger point.
+    strength_order = np.argsort(-coords_h, kind = "stable")
+    sort_indices = strength_order[np.argsort(-suppress_radius[strength_order],
+        kind = "stable")]
     candidate_indices = sort_indices[:max_pts]
+    count("survivors", len(candidate_indices))
     return coords[:, candidate_indices]
 
 
+def _dense_suppress_radius(coords_h, coords, c_robust):
+    """
+    Compute the squared suppression radius of every point from the full
+    N x N distance matrix.
+    """
+    coords_dist = dist2(coords.T, coords.T)
+    mask = np.less.outer(coords_h, c_robust * coords_h)
+    coords_dist_masked = np.where(mask, coords_dist, np.inf)
+    return np.min(coords_dist_masked, axis = 1)
+
+
+def _kdtree_suppress_radius(coords_h, coords, c_robust, num_neighbors = 16,
+    max_neighbors = 128):
+    """
+    Compute the squared suppression radius of every point with KD-trees.
+    Points are sorted by descending strength, so the points able to suppress
+    a given point form a prefix of that order. The nearest neighbors of each
+    point are queried in a tree over all points until one of them lies in its
+    prefix. The few points left over are among the strongest, so they are
+    queried in trees over short prefixes of doubling size instead.
+    """
+    num_pts = len(coords_h)
+    radius = np.full(num_pts, np.inf)
+    if num_pts == 0:
+        return radius
+    order = np.argsort(-coords_h, kind = "stable")
+    h_sorted = coords_h[order]
+    pts = coords.T[order].astype(np.float64)
+    # Number of points j with c_robust * h_j > h_i, for each point i in sorted
+    # order.
+    num_suppressors = np.searchsorted(-c_robust * h_sorted, -h_sorted,
+        side = "left")
+
+    pending = np.nonzero(num_suppressors > 0)[0]
+    pending = _nearest_suppressor(spatial.cKDTree(pts), pts, pending,
+        num_suppressors, radius, num_neighbors, max_neighbors)
+    prefix_size = 1
+    while len(pending) > 0:
+        prefix_size = min(2 * prefix_size, num_pts)
+        bucket = num_suppressors[pending] <= prefix_size
+        if np.any(bucket):
+            # Every point of the bucket has a suppressor in the prefix, so
+            # querying up to prefix_size neighbors always finds one.
+            _nearest_suppressor(spatial.cKDTree(pts[:prefix_size]), pts,
+                pending[bucket], num_suppressors, radius, num_neighbors,
+                prefix_size)
+            pending = pending[~bucket]
+
+    suppress_radius = np.empty(num_pts)
+    suppress_radius[order] = radius
+    return suppress_radius
+
+
+def _nearest_suppressor(tree, pts, pending, num_suppressors, radius,
+    num_neighbors, max_neighbors):
+    """
+    For each pending point, query its nearest neighbors in tree, doubling
+    their number up to max_neighbors, and record the squared distance to the
+    nearest one that can suppress it in radius. Returns the points for which
+    none was found.
+    """
+    k = min(num_neighbors, tree.n)
+    while len(pending) > 0:
+        dist, idx = tree.query(pts[pending], k = k)
+        dist = dist.reshape((len(pending), -1))
+        idx = idx.reshape((len(pending), -1))
+        # Neighbors are sorted by distance, so the first suppressor found is
+        # the nearest one.
+        valid = idx < num_suppressors[pending, np.newaxis]
+        found = np.any(valid, axis = 1)
+        first = np.argmax(valid, axis = 1)
+        radius[pending[found]] = dist[found, first[found]] ** 2
+        pending = pending[~found]
+        if k >= min(max_neighbors, tree.n):
+            break
+        k = min(2 * k, tree.n)
+    return pending
+
+
 if __name__ == "__main__":
     # Compute non-max suppressed feature points of "mosaic3_left.jpeg".
     im = skio.imread("mosaic3_left.jpeg")
@@ -0,0 +1,590 @@
+import collections
+import itertools
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+import numpy as np
+import skimage.io as skio
+from skimage.transform import rescale
+from harris import get_harris_corners
+from non_max_suppression import non_max_suppression
+from descriptor_extraction import extract_descriptor
+from feature_matching import match_feature, match_feature_guided
+from feature_matching import default_threshold
+from descriptor_index import DescriptorIndex
+from ransac import ransac, score_hypotheses, check_confidence
+from compute_projection import computeH_normalized, refine_homography
+from composite import composite
+from feature_cache import default_params
+from pyramid import register_pyramid, pyramid_features_all, level_transform
+
+
+def detect_and_describe(im, max_pts = 1000, c_robust = 0.9, edge_discard = 20,
+    min_distance = 1, patch_height = 40, patch_width = 40, resize_ratio = 5,
+    descriptor_mode = "float", region = None):
+    """
+    Find the feature points of an image and extract their descriptors.
+    Returns the feature point locations, of shape (2, n), and their
+    descriptors.
+    :param im: Input image, or path of the image file.
+    :param max_pts: Number of feature points retained by non-max suppression.
+    :param c_robust: hyperparameter to suppress radius around a feature point.
+    :param edge_discard: Harris corners closer to the edge are discarded.
+    :param min_distance: Minimum distance between Harris corners.
+    :param patch_height: Height of the patch of feature descriptors.
+    :param patch_width: Width of the patch of feature descriptors.
+    :param resize_ratio: Subsampling ratio of feature descriptors.
+    :param descriptor_mode: "float", "float16", "int8" or "binary"
+        descriptors (see extract_descriptor).
+    :param region: Optional region (r_min, r_max, c_min, c_max) of the
+        image, e.g. its predicted overlap with another image (see
+        overlap_regions). Only feature points within it are detected and
+        described, and max_pts are retained within it. Locations are still
+        given in the full image.
+    """
+    im_gray = to_gray(load_image(im))
+    # Crop the region, extended by edge_discard so that its own corners are
+    # not discarded as too close to the edge of the crop.
+    top, left = 0, 0
+    if region is not None:
+        r_min, r_max, c_min, c_max = region
+        top, left = max(r_min - edge_discard, 0), max(c_min - edge_discard, 0)
+        im_gray = im_gray[top: r_max + edge_discard,
+            left: c_max + edge_discard]
+    h, coords = get_harris_corners(im_gray, edge_discard = edge_discard,
+        min_distance = min_distance)
+    coords = non_max_suppression(h, coords, max_pts = max_pts,
+        c_robust = c_robust)
+    descriptor = extract_descriptor(im_gray, coords,
+        patch_height = patch_height, patch_width = patch_width,
+        resize_ratio = resize_ratio, mode = descriptor_mode)
+    return coords + np.array([[top], [left]]), descriptor
+
+
+def detect_and_describe_all(images, executor, cache = None, regions = None,
+    **params):
+    """
+    Run detect_and_describe on every image in the executor. Images found in
+    the cache are not processed again, and new results are added to it.
+    Returns a list of (feature point locations, descriptors).
+    :param images: List of images, or paths of the image files.
+    :param executor: concurrent.futures executor running the detection.
+    :param cache: Optional FeatureCache.
+    :param regions: Optional region of every image to detect in (None for
+        the full image), see detect_and_describe.
+    :param params: Parameters of detect_and_describe.
+    """
+    if regions is None:
+        regions = [None] * len(images)
+    features = [None] * len(images)
+    if cache is not None:
+        # Key on every parameter, including defaults and those of the
+        # stages, so that changing a default invalidates the cache.
+        params_full = default_params(detect_and_describe, get_harris_corners,
+            non_max_suppression, extract_descriptor)
+        params_full["detect_and_describe"].update(params)
+        keys = [cache.key(im, **dict(params_full, detect_and_describe = dict(
+            params_full["detect_and_describe"], region = region)))
+            for im, region in zip(images, regions)]
+        for i, key in enumerate(keys):
+            entry = cache.get(key, ("coords", "descriptor"))
+            if entry is not None:
+                features[i] = (entry["coords"], entry["descriptor"])
+
+    missing = [i for i in range(len(images)) if features[i] is None]
+    results = executor.map(partial(_detect_and_describe_region,
+        params = params), [images[i] for i in missing],
+        [regions[i] for i in missing])
+    for i, (coords, descriptor) in zip(missing, results):
+        features[i] = (coords, descriptor)
+        if cache is not None:
+            cache.put(keys[i], coords = coords, descriptor = descriptor)
+    return features
+
+
+def match_pair(features1, features2, match_threshold = None,
+    ransac_threshold = 4, max_iter = 500, seed = None,
+    return_num_matches = False, guided_radius = None, initial_pts = None,
+    ransac_confidence = None, prosac = False, index = None):
+    """
+    Estimate the projective transformation from image 1 to image 2.
+    Returns the transformation matrix and its number of inliers, or
+    (None, 0) if no transformation is found.
+    With guided_radius, the transformation estimated by RANSAC from the
+    first initial_pts feature points of each image is only a first
+    estimate: all feature points are then matched by match_feature_guided
+    around their predicted locations, and the transformation is refit by
+    least squares on those matchings that are inliers of the estimate.
+    :param features1: Feature points and descriptors of image 1, as returned
+        by detect_and_describe.
+    :param features2: Feature points and descriptors of image 2.
+    :param match_threshold: Ratio threshold of match_feature. Defaults to
+        the threshold of the descriptor type (see default_threshold).
+    :param ransac_threshold: Inlier threshold of ransac.
+    :param max_iter: Number of iterations of ransac.
+    :param seed: Seed of the random number generator of ransac.
+    :param return_num_matches: If True, also return the number of matchings
+        (of the guided matching, if any) passed to the final fit.
+    :param guided_radius: If given, search radius in pixels of the guided
+        matching.
+    :param initial_pts: Number of feature points of each image used for the
+        first estimate when guided_radius is given. Feature points from
+        non_max_suppression come strongest first, so these are the points
+        that a smaller max_pts would have kept. Defaults to all points.
+    :param ransac_confidence: If given, ransac stops as soon as it has found
+        an all-inlier sample with this probability, and max_iter is only a
+        cap.
+    :param prosac: If True, ransac samples the matchings with the best ratio
+        test scores of match_feature first (PROSAC).
+    :param index: Optional DescriptorIndex built over the descriptors of
+        image 2 (its first initial_pts ones with guided_radius), to look up
+        the matchings of match_feature in instead of comparing every pair of
+        descriptors.
+    """
+    check_confidence(ransac_confidence)
+    coords1, descriptor1 = features1
+    coords2, descriptor2 = features2
+    if match_threshold is None:
+        match_threshold = default_threshold(descriptor1)
+    im1_coords, im2_coords, scores = match_feature(descriptor1[:initial_pts],
+        descriptor2[:initial_pts], coords1[:, :initial_pts],
+        coords2[:, :initial_pts], match_threshold, index = index,
+        return_scores = True)
+    try:
+        H, inlier = ransac(im1_coords, im2_coords, max_iter = max_iter,
+            threshold = ransac_threshold, seed = seed,
+            confidence = ransac_confidence,
+            scores = scores if prosac else None)
+        result = H, int(np.sum(inlier))
+    except ValueError:
+        result = None, 0
+    if guided_radius is not None and result[0] is not None:
+        # Densify the matchings around the first estimate and refit on all of
+        # its inliers among them.
+        im1_coords, im2_coords = match_feature_guided(descriptor1,
+            descriptor2, coords1, coords2, H, match_threshold,
+            radius = guided_radius)
+        inlier = score_hypotheses(H[np.newaxis], np.concatenate((im1_coords,
+            np.ones((1, im1_coords.shape[1])))), im2_coords,
+            ransac_threshold)[0]
+        if np.sum(inlier) >= result[1]:
+            im1_inliers = im1_coords[:, inlier].T
+            im2_inliers = im2_coords[:, inlier].T
+            H = computeH_normalized(im1_inliers[np.newaxis],
+                im2_inliers[np.newaxis])[0]
+            H = refine_homography(H, im1_inliers, im2_inliers)
+            # Keep the first estimate if the refit is degenerate.
+            if np.all(np.isfinite(H)):
+                result = H / H[2, 2], int(np.sum(inlier))
+    if return_num_matches:
+        return result + (im1_coords.shape[1],)
+    return result
+
+
+def layout_homography(shape1, overlap = 0.35):
+    """
+    Rough projective transformation from image 1 to image 2 for a known
+    capture layout: image 2 is to the right of image 1, at the same height,
+    and they share the given fraction of the width of image 1.
+    :param shape1: Shape of image 1.
+    :param overlap: Fraction of the width of image 1 covered by image 2.
+    """
+    return np.array([[1, 0, 0], [0, 1, -(1 - overlap) * shape1[1]],
+        [0, 0, 1]])
+
+
+def thumbnail_homography(im1, im2, downscale = 4, max_pts = 500,
+    c_robust = 0.9, match_threshold = 0.27, ransac_threshold = 4,
+    max_iter = 500, seed = None):
+    """
+    Rough projective transformation from image 1 to image 2, registered on
+    thumbnails downscaled by downscale. Returns the transformation matrix at
+    full resolution, or None if the thumbnails could not be registered.
+    :param im1: Image 1, or path of the image file.
+    :param im2: Image 2, or path of the image file.
+    :param downscale: Downscale factor of the thumbnails.
+    :param max_pts: Number of feature points retained by non-max suppression
+        on the thumbnails.
+    :param c_robust: hyperparameter to suppress radius around a feature point.
+    :param match_threshold: Ratio threshold of match_feature.
+    :param ransac_threshold: Inlier threshold of ransac.
+    :param max_iter: Number of iterations of ransac.
+    :param seed: Seed of the random number generator of ransac.
+    """
+    im1_gray, im2_gray = to_gray(load_image(im1)), to_gray(load_image(im2))
+    thumbnail1, thumbnail2 = [rescale(im, 1 / downscale, anti_aliasing = True)
+        for im in (im1_gray, im2_gray)]
+    H, _ = match_pair(detect_and_describe(thumbnail1, max_pts = max_pts,
+        c_robust = c_robust), detect_and_describe(thumbnail2,
+        max_pts = max_pts, c_robust = c_robust),
+        match_threshold = match_threshold, ransac_threshold = ransac_threshold,
+        max_iter = max_iter, seed = seed)
+    if H is None:
+        return None
+    A1 = level_transform(im1_gray.shape, thumbnail1.shape)
+    A2 = level_transform(im2_gray.shape, thumbnail2.shape)
+    H = np.dot(np.linalg.inv(A2), np.dot(H, A1))
+    return H / H[2, 2]
+
+
+def overlap_regions(shape1, shape2, H, margin = 50):
+    """
+    Predict where two images overlap from a rough projective transformation
+    between them. Returns the bounding box (r_min, r_max, c_min, c_max) of
+    the part of image 1 covered by image 2, and that of the part of image 2
+    covered by image 1, each extended by margin pixels and clipped to its
+    image. A region is None (the full image) if the images are not
+    predicted to overlap, or if the transformation folds the other image
+    behind the camera.
+    :param shape1: Shape of image 1.
+    :param shape2: Shape of image 2.
+    :param H: Projective transformation matrix from image 1 to image 2, e.g.
+        from thumbnail_homography, layout_homography or an earlier
+        registration.
+    :param margin: Margin in pixels around the predicted overlap, to allow
+        for the error of H.
+    """
+    return _overlap_region(shape1, shape2, np.linalg.inv(H), margin), \
+        _overlap_region(shape2, shape1, H, margin)
+
+
+def stitch(images, ordered = True, max_pts = 1000, c_robust = 0.9,
+    match_threshold = None, ransac_threshold = 4, max_iter = 500,
+    min_inliers = 10, blend = "feather", max_workers = None, seed = None,
+    cache = None, pyramid_levels = 1, descriptor_mode = "float",
+    guided_pts = None, guided_radius = 8, overlap_prior = None,
+    overlap_margin = 50, ransac_confidence = None, prosac = False,
+    use_index = False, executor = None, report = None):
+    """
+    Stitch N images into one panorama. Features of all images are detected
+    and described in parallel, candidate pairs are matched in parallel, and
+    the pairwise transformations are chained to a reference image before all
+    images are composited at once.
+    Returns the panorama, the offset of its top-left pixel in the reference
+    image, and for each image the reversed projective transformation from the
+    reference image to it (None for images that could not be registered).
+    :param images: List of images, or paths of the image files.
+    :param ordered: If True, images are in panorama order, only neighbors are
+        matched and the middle image is the reference. Otherwise every pair
+        is matched and the best connected image is the reference.
+    :param max_pts: Number of feature points retained by non-max suppression.
+    :param c_robust: hyperparameter to suppress radius around a feature point.
+    :param match_threshold: Ratio threshold of match_feature. Defaults to
+        0.27, or 0.6 for binary descriptors (see MATCH_THRESHOLDS).
+    :param ransac_threshold: Inlier threshold of ransac.
+    :param max_iter: Number of iterations of ransac.
+    :param min_inliers: Minimum number of inliers for a pair to be linked.
+    :param blend: Blending mode of composite.
+    :param max_workers: Number of worker processes. Defaults to the number of
+        processors.
+    :param seed: Seed of the random number generator of ransac.
+    :param cache: Optional FeatureCache, so that features of images seen
+        before are not detected and described again.
+    :param pyramid_levels: If greater than 1, each pair is registered coarse
+        to fine on Gaussian pyramids with this many levels (see
+        register_pyramid) instead of with features at full resolution.
+    :param descriptor_mode: "float", "float16", "int8" or "binary"
+        descriptors (see extract_descriptor). Quantized and binary
+        descriptors are smaller to cache and to transfer between processes.
+        For binary descriptors, match_threshold applies to Hamming distances.
+    :param guided_pts: If given, this many feature points are detected per
+        image. Each pair is first registered with the strongest max_pts of
+        them, and all of them are then matched guided by that estimate for
+        the final fit (see match_pair).
+    :param guided_radius: Search radius in pixels of the guided matching.
+    :param overlap_prior: If given, features of each pair are only detected
+        and described within the predicted overlap of its two images (see
+        overlap_regions), so max_pts are retained there. The overlap is
+        predicted from "thumbnail" registration (see thumbnail_homography),
+        from a known layout given as the overlap fraction of consecutive
+        images from left to right (see layout_homography), or from a list
+        of rough transformation matrices, one per pair (e.g. from an earlier
+        run), with None for the pairs to detect in full.
+    :param overlap_margin: Margin in pixels around the predicted overlap.
+    :param ransac_confidence: If given, ransac stops adaptively once it has
+        found an all-inlier sample with this probability (see match_pair).
+    :param prosac: If True, ransac samples the best scored matchings first
+        (see match_pair).
+    :param use_index: If True, the descriptors of every image are indexed
+        once in a DescriptorIndex, and the index is used for every pair the
+        image is matched in (see match_pair). This only pays off when images
+        are matched against several others, i.e. with ordered = False: in
+        ordered mode each index serves a single pair, and is built by the
+        worker matching it. Not available with binary descriptors or with
+        pyramid_levels.
+    :param executor: Optional concurrent.futures executor to run detection
+        and matching in, instead of a new process pool of max_workers.
+    :param report: Optional dictionary, filled with the number of feature
+        points of every image, the number of matchings and inliers of every
+        pair, the reference image and the time spent in each stage.
+    """
+    if use_index and (descriptor_mode == "binary" or pyramid_levels > 1):
+        raise ValueError("use_index needs non-binary descriptors and " +
+            "pyramid_levels = 1")
+    num_images = len(images)
+    if ordered:
+        pairs = [(i, i + 1) for i in range(num_images - 1)]
+    else:
+        pairs = list(itertools.combinations(range(num_images), 2))
+
+    # Use a new process pool unless an executor is given.
+    if executor is None:
+        pool = ProcessPoolExecutor(max_workers = max_workers)
+    else:
+        pool = nullcontext(executor)
+    timings = {}
+    with pool as executor:
+        features, matches = _register_pairs(images, pairs, executor, timings,
+            max_pts = max_pts, c_robust = c_robust,
+            match_threshold = match_threshold,
+            ransac_threshold = ransac_threshold, max_iter = max_iter,
+            seed = seed, cache = cache, pyramid_levels = pyramid_levels,
+            descriptor_mode = descriptor_mode, guided_pts = guided_pts,
+            guided_radius = guided_radius, overlap_prior = overlap_prior,
+            overlap_margin = overlap_margin,
+            ransac_confidence = ransac_confidence, prosac = prosac,
+            use_index = use_index)
+
+    # Keep the pairs with enough inliers and a finite transformation, in both
+    # directions.
+    edges = {}
+    for (i, j), (H, num_inliers, _) in zip(pairs, matches):
+        if H is not None and num_inliers >= min_inliers and \
+            np.all(np.isfinite(H)):
+            edges[(i, j)] = (H, num_inliers)
+            edges[(j, i)] = (np.linalg.inv(H), num_inliers)
+
+    if ordered:
+        reference = (num_images - 1) // 2
+    else:
+        reference = max(range(num_images), key = lambda i: sum(
+            n for (a, _), (_, n) in edges.items() if a == i))
+    homographies = chain_homographies(num_images, edges, reference)
+
+    images = [load_image(im) for im in images]
+    registered = [i for i in range(num_images) if homographies[i] is not None]
+    start = time.perf_counter()
+    panorama, offset = composite([images[i] for i in registered],
+        [homographies[i] for i in registered], blend = blend)
+    timings["composite"] = time.perf_counter() - start
+
+    if report is not None:
+        report["features"] = None if features is None else \
+            [coords.shape[1] for coords, _ in features]
+        report["pairs"] = [{"images": [i, j], "matches": num_matches,
+            "inliers": num_inliers} for (i, j), (_, num_inliers, num_matches)
+            in zip(pairs, matches)]
+        report["reference"] = reference
+        report["registered"] = registered
+        report["timings"] = timings
+    return panorama, offset, homographies
+
+
+def _register_pairs(images, pairs, executor, timings, max_pts, c_robust,
+    match_threshold, ransac_threshold, max_iter, seed, cache, pyramid_levels,
+    descriptor_mode, guided_pts, guided_radius, overlap_prior,
+    overlap_margin, ransac_confidence, prosac, use_index):
+    """
+    Estimate the transformation of every pair in the executor, and record
+    the time spent in each stage in timings. Returns the features of every
+    image (None when registering on pyramids or within overlaps) and, for
+    every pair, the transformation matrix, its number of inliers and the
+    number of matchings (None when registering on pyramids).
+    """
+    if pyramid_levels > 1:
+        # The features of the coarsest levels are found once per image, and
+        # looked up in the cache in this process.
+        start = time.perf_counter()
+        features = pyramid_features_all(images, executor, cache = cache,
+            num_levels = pyramid_levels, max_pts = max_pts,
+            c_robust = c_robust, descriptor_mode = descriptor_mode)
+        timings["features"] = time.perf_counter() - start
+        start = time.perf_counter()
+        matches = list(executor.map(partial(_register_pyramid_features,
+            params = dict(num_levels = pyramid_levels, max_pts = max_pts,
+            c_robust = c_robust, match_threshold = match_threshold,
+            ransac_threshold = ransac_threshold, max_iter = max_iter,
+            seed = seed, descriptor_mode = descriptor_mode,
+            ransac_confidence = ransac_confidence, prosac = prosac)),
+            [images[i] for i, _ in pairs], [images[j] for _, j in pairs],
+            [features[i] for i, _ in pairs], [features[j] for _, j in pairs]))
+        timings["pyramid"] = time.perf_counter() - start
+        return None, [(H, num_inliers, None) for H, num_inliers in matches]
+
+    # Without an overlap prior, the features of every image are detected
+    # once. Otherwise, both images of every pair are detected within their
+    # predicted overlap.
+    if overlap_prior is None:
+        tasks, regions = list(range(len(images))), None
+        tasks1, tasks2 = [i for i, _ in pairs], [j for _, j in pairs]
+    else:
+        start = time.perf_counter()
+        if not isinstance(overlap_prior, (str, int, float)):
+            priors = list(overlap_prior)
+        else:
+            priors = [overlap_prior] * len(pairs)
+        pair_regions = list(executor.map(partial(_pair_regions,
+            margin = overlap_margin, max_pts = max_pts, c_robust = c_robust,
+            match_threshold = match_threshold,
+            ransac_threshold = ransac_threshold, max_iter = max_iter,
+            seed = seed), [images[i] for i, _ in pairs],
+            [images[j] for _, j in pairs], priors))
+        timings["prior"] = time.perf_counter() - start
+        tasks = [i for pair in pairs for i in pair]
+        regions = [region for pair in pair_regions for region in pair]
+        tasks1 = list(range(0, len(tasks), 2))
+        tasks2 = list(range(1, len(tasks), 2))
+
+    start = time.perf_counter()
+    features = detect_and_describe_all([images[i] for i in tasks], executor,
+        cache = cache, regions = regions,
+        max_pts = max_pts if guided_pts is None else guided_pts,
+        c_robust = c_robust, descriptor_mode = descriptor_mode)
+    timings["features"] = time.perf_counter() - start
+
+    # Index the descriptors of image 2 of every pair (only the initial ones
+    # with guided matching, see match_pair). An image that is image 2 of
+    # several pairs is indexed once and the index is sent to every pair;
+    # otherwise the index would not be reused, and is built by the worker
+    # matching the pair rather than sent to it.
+    indices = [None] * len(features)
+    build_index = [False] * len(pairs)
+    if use_index:
+        start = time.perf_counter()
+        uses = collections.Counter(tasks2)
+        indexed = sorted(k for k, n in uses.items() if n > 1)
+        for k, index in zip(indexed, executor.map(DescriptorIndex,
+            [features[k][1][:None if guided_pts is None else max_pts]
+            for k in indexed])):
+            indices[k] = index
+        build_index = [uses[k] == 1 for k in tasks2]
+        timings["index"] = time.perf_counter() - start
+    start = time.perf_counter()
+    matches = list(executor.map(partial(_match_pair_indexed,
+        params = dict(match_threshold = match_threshold,
+        ransac_threshold = ransac_threshold, max_iter = max_iter, seed = seed,
+        return_num_matches = True,
+        guided_radius = None if guided_pts is None else guided_radius,
+        initial_pts = None if guided_pts is None else max_pts,
+        ransac_confidence = ransac_confidence, prosac = prosac)),
+        [features[k] for k in tasks1], [features[k] for k in tasks2],
+        [indices[k] for k in tasks2], build_index))
+    timings["matching"] = time.perf_counter() - start
+    return (features if overlap_prior is None else None), matches
+
+
+def chain_homographies(num_images, edges, reference):
+    """
+    Chain pairwise transformations into transformations from the reference
+    image to every image, following a maximum spanning tree of the number of
+    inliers. Returns a list with None for the images not connected to the
+    reference.
+    :param num_images: Number of images.
+    :param edges: Dictionary mapping (i, j) to (H, number of inliers), where
+        H transforms points of image i into image j.
+    :param reference: Index of the reference image.
+    """
+    homographies = [None] * num_images
+    homographies[reference] = np.eye(3)
+    while True:
+        # Grow the tree with the strongest pair linking it to a new image.
+        candidates = [(n, i, j) for (i, j), (_, n) in edges.items()
+            if homographies[i] is not None and homographies[j] is None]
+        if not candidates:
+            return homographies
+        _, i, j = max(candidates)
+        H = np.dot(edges[(i, j)][0], homographies[i])
+        homographies[j] = H / H[2, 2]
+
+
+def _detect_and_describe_region(im, region, params):
+    """
+    Run detect_and_describe within a region, for executor.map.
+    """
+    return detect_and_describe(im, region = region, **params)
+
+
+def _match_pair_indexed(features1, features2, index, build_index, params):
+    """
+    Run match_pair with an optional DescriptorIndex of image 2, or with one
+    built here if build_index is True, for executor.map.
+    """
+    if build_index:
+        index = DescriptorIndex(features2[1][:params["initial_pts"]])
+    return match_pair(features1, features2, index = index, **params)
+
+
+def _register_pyramid_features(im1, im2, features1, features2, params):
+    """
+    Run register_pyramid with the features of the coarsest levels found
+    beforehand, for executor.map.
+    """
+    return register_pyramid(im1, im2, features1 = features1,
+        features2 = features2, **params)
+
+
+def _pair_regions(im1, im2, prior, margin, max_pts, c_robust, match_threshold,
+    ransac_threshold, max_iter, seed):
+    """
+    Predict the overlap regions of a pair from its prior: "thumbnail", an
+    overlap fraction of a left-to-right layout, a transformation matrix, or
+    None. Returns the regions of image 1 and image 2.
+    """
+    if prior is None:
+        return None, None
+    im1, im2 = load_image(im1), load_image(im2)
+    if isinstance(prior, str):
+        if prior != "thumbnail":
+            raise ValueError(f"Unknown overlap prior: {prior}")
+        H = thumbnail_homography(im1, im2, max_pts = max_pts,
+            c_robust = c_robust, match_threshold = match_threshold,
+            ransac_threshold = ransac_threshold, max_iter = max_iter,
+            seed = seed)
+    elif np.ndim(prior) == 0:
+        H = layout_homography(im1.shape, prior)
+    else:
+        H = np.asarray(prior, dtype = float)
+    if H is None:
+        return None, None
+    return overlap_regions(im1.shape, im2.shape, H, margin)
+
+
+def _overlap_region(shape, shape_other, H, margin):
+    """
+    Bounding box of the part of an image covered by the other image, whose
+    pixels H transforms into it, extended by margin and clipped to the
+    image. None if they do not overlap or if a corner of the other image
+    is transformed behind the camera.
+    """
+    corners = np.array([[0, 0, shape_other[0] - 1, shape_other[0] - 1],
+        [0, shape_other[1] - 1, 0, shape_other[1] - 1], [1, 1, 1, 1]])
+    corners_trans = np.dot(H, corners)
+    if not (np.all(corners_trans[2] > 0) or np.all(corners_trans[2] < 0)):
+        return None
+    corners_trans = corners_trans[:2] / corners_trans[2]
+    r_min = max(int(np.floor(np.min(corners_trans[0]))) - margin, 0)
+    r_max = min(int(np.ceil(np.max(corners_trans[0]))) + 1 + margin,
+        shape[0])
+    c_min = max(int(np.floor(np.min(corners_trans[1]))) - margin, 0)
+    c_max = min(int(np.ceil(np.max(corners_trans[1]))) + 1 + margin,
+        shape[1])
+    if r_min >= r_max or c_min >= c_max:
+        return None
+    return r_min, r_max, c_min, c_max
+
+
+def load_image(im):
+    """
+    Read the image if a path is given.
+    :param im: Image, or path of the image file.
+    """
+    return skio.imread(im) if isinstance(im, str) else im
+
+
+def to_gray(im):
+    """
+    Take the first channel of a color image for feature detection.
+    :param im: Grayscale or color image.
+    """
+    return im[:, :, 0] if len(im.shape) == 3 else im
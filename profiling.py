@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+from functools import wraps
+
+# Profiler collecting the stages of this process, or None when profiling is
+# disabled.
+_active = None
+
+
+class Profiler:
+    """
+    Records the wall time, CPU time, peak traced memory and counts of every
+    profiled stage run while it is active, e.g.
+
+        with Profiler() as profiler:
+            stitch(files, executor = ThreadPoolExecutor())
+        profiler.write_trace("trace.json")
+
+    Only stages run in this process are recorded, so stitch should be given
+    a thread pool rather than its default process pool. When no profiler is
+    active, profiled functions cost a single global lookup.
+    :param memory: If True, trace memory allocations with tracemalloc to
+        report the peak memory of each stage. This slows allocations down,
+        and the peak of stages running concurrently in several threads is
+        shared between them.
+    """
+
+    def __init__(self, memory = True):
+        self.memory = memory
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+        self._previous = None
+        self._started_tracing = False
+
+    def __enter__(self):
+        global _active
+        self._previous = _active
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        _active = self
+        return self
+
+    def __exit__(self, *exc_info):
+        global _active
+        _active = self._previous
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return False
+
+    def stage(self, name):
+        """
+        Context manager recording a stage named name.
+        """
+        return _Stage(self, name)
+
+    def summary(self):
+        """
+        Totals of every stage name: number of calls, wall and CPU time, the
+        largest peak memory and the sum of every count.
+        """
+        summary = {}
+        for record in self.records:
+            total = summary.setdefault(record["name"], {"calls": 0,
+                "wall_time": 0.0, "cpu_time": 0.0, "peak_memory": None,
+                "counts": {}})
+            total["calls"] += 1
+            total["wall_time"] += record["wall_time"]
+            total["cpu_time"] += record["cpu_time"]
+            if record["peak_memory"] is not None:
+                total["peak_memory"] = max(total["peak_memory"] or 0,
+                    record["peak_memory"])
+            for key, value in record["counts"].items():
+                total["counts"][key] = total["counts"].get(key, 0) + value
+        return summary
+
+    def write_json(self, path):
+        """
+        Write the records and the summary as JSON.
+        """
+        with open(path, "w") as f:
+            json.dump({"records": self.records, "summary": self.summary()},
+                f, indent = 2)
+
+    def write_trace(self, path):
+        """
+        Write the records in the Chrome trace_event format, which can be
+        opened in chrome://tracing or Perfetto.
+        """
+        events = [{"name": record["name"], "ph": "X",
+            "ts": record["start"] * 1e6, "dur": record["wall_time"] * 1e6,
+            "pid": record["pid"], "tid": record["tid"],
+            "args": dict(record["counts"], cpu_time = record["cpu_time"],
+                peak_memory = record["peak_memory"])}
+            for record in self.records]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def _stack(self):
+        """
+        Stages currently running in this thread, innermost last.
+        """
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+
+class _Stage:
+    """
+    A running stage of a Profiler.
+    """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.counts = {}
+
+    def __enter__(self):
+        stack = self.profiler._stack()
+        if self.profiler.memory and tracemalloc.is_tracing():
+            # Keep the peak of the enclosing stage before restarting it.
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            self.base = current
+            self.peak = current
+        stack.append(self)
+        self.start = time.perf_counter()
+        self.start_cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall_time = time.perf_counter() - self.start
+        cpu_time = time.thread_time() - self.start_cpu
+        stack = self.profiler._stack()
+        stack.pop()
+        peak_memory = None
+        if self.profiler.memory and tracemalloc.is_tracing():
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            peak_memory = self.peak - self.base
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+        record = {"name": self.name,
+            "start": self.start - self.profiler._origin,
+            "wall_time": wall_time, "cpu_time": cpu_time,
+            "peak_memory": peak_memory, "counts": self.counts,
+            "pid": os.getpid(), "tid": threading.get_ident()}
+        with self.profiler._lock:
+            self.profiler.records.append(record)
+        return False
+
+
+def profiled(name):
+    """
+    Decorator recording every call of a function as a stage named name of
+    the active profiler. Calls made within a stage of the same name (e.g.
+    recursive calls) are part of that stage.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            profiler = _active
+            if profiler is None:
+                return function(*args, **kwargs)
+            stack = profiler._stack()
+            if stack and stack[-1].name == name:
+                return function(*args, **kwargs)
+            with profiler.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(key, value):
+    """
+    Add value to the count key of the innermost stage running in this
+    thread. Does nothing when profiling is disabled.
+    """
+    profiler = _active
+    if profiler is None:
+        return
+    stack = profiler._stack()
+    if stack:
+        stage = stack[-1]
+        stage.counts[key] = stage.counts.get(key, 0) + int(value)
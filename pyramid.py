@@ -0,0 +1,315 @@
+from functools import partial
+import numpy as np
+import skimage.io as skio
+from skimage.transform import pyramid_gaussian
+from harris import get_harris_corners
+from non_max_suppression import non_max_suppression
+from descriptor_extraction import extract_descriptor
+from feature_matching import match_feature, default_threshold
+from feature_matching import pair_distances
+from ransac import ransac, check_confidence
+from feature_cache import default_params
+
+
+def build_pyramid(im, num_levels, downscale = 2):
+    """
+    Build the Gaussian pyramid of an image, used for feature detection.
+    Color images use their first channel. Returns a list of num_levels
+    images, from the finest (the input image) to the coarsest.
+    :param im: Input image.
+    :param num_levels: Number of levels of the pyramid.
+    :param downscale: Downscale factor between two levels.
+    """
+    im_gray = im[:, :, 0] if len(im.shape) == 3 else im
+    return list(pyramid_gaussian(im_gray, max_layer = num_levels - 1,
+        downscale = downscale))
+
+
+def pyramid_features(im, num_levels = 3, downscale = 2, max_pts = 1000,
+    c_robust = 0.9, descriptor_mode = "float"):
+    """
+    Find the feature points of the coarsest level of the Gaussian pyramid of
+    an image and extract their descriptors, as register_pyramid does.
+    Returns the feature point locations, in coordinates of the coarsest
+    level, and their descriptors.
+    :param im: Input image, or path of the image file.
+    :param num_levels: Number of levels of the pyramid.
+    :param downscale: Downscale factor between two levels.
+    :param max_pts: Number of feature points retained by non-max suppression.
+    :param c_robust: hyperparameter to suppress radius around a feature point.
+    :param descriptor_mode: "float", "float16", "int8" or "binary"
+        descriptors (see extract_descriptor).
+    """
+    im = skio.imread(im) if isinstance(im, str) else im
+    pyramid = build_pyramid(im, num_levels, downscale)
+    return _features(pyramid[-1], max_pts, c_robust, descriptor_mode)
+
+
+def pyramid_features_all(images, executor, cache = None, **params):
+    """
+    Run pyramid_features on every image in the executor. Images found in the
+    cache are not processed again, and new results are added to it; the
+    cache is only used in the calling process, so its statistics count every
+    lookup. Returns a list of (feature point locations, descriptors).
+    :param images: List of images, or paths of the image files.
+    :param executor: concurrent.futures executor running the detection.
+    :param cache: Optional FeatureCache.
+    :param params: Parameters of pyramid_features.
+    """
+    features = [None] * len(images)
+    if cache is not None:
+        params_full = default_params(pyramid_features)["pyramid_features"]
+        params_full.update(params)
+        keys = [_cache_key(cache, im, params_full) for im in images]
+        for i, key in enumerate(keys):
+            entry = cache.get(key, ("coords", "descriptor"))
+            if entry is not None:
+                features[i] = (entry["coords"], entry["descriptor"])
+
+    missing = [i for i in range(len(images)) if features[i] is None]
+    results = executor.map(partial(pyramid_features, **params),
+        [images[i] for i in missing])
+    for i, (coords, descriptor) in zip(missing, results):
+        features[i] = (coords, descriptor)
+        if cache is not None:
+            cache.put(keys[i], coords = coords, descriptor = descriptor)
+    return features
+
+
+def register_pyramid(im1, im2, num_levels = 3, downscale = 2, radius = 4,
+    max_pts = 1000, c_robust = 0.9, match_threshold = None,
+    window_threshold = 0.8, ransac_threshold = 4, max_iter = 500,
+    refine_iter = 100, seed = None, descriptor_mode = "float", cache = None,
+    ransac_confidence = None, prosac = False, features1 = None,
+    features2 = None):
+    """
+    Estimate the projective transformation from image 1 to image 2 coarse to
+    fine. The full detection, matching and RANSAC chain only runs on the
+    coarsest level of the Gaussian pyramids. At each finer level, the feature
+    points of image 1 are carried over, each one is matched to the location
+    within radius pixels of its prediction by the current transformation
+    whose descriptor is closest, to sub-pixel precision, and the
+    transformation is refined with a short RANSAC on those matchings.
+    Returns the transformation matrix at full resolution and its number of
+    inliers, or (None, 0) if no transformation is found.
+    :param im1: Image 1, or path of the image file.
+    :param im2: Image 2, or path of the image file.
+    :param num_levels: Number of levels of the pyramids.
+    :param downscale: Downscale factor between two levels.
+    :param radius: Search radius in pixels around predicted locations.
+    :param max_pts: Number of feature points retained by non-max suppression
+        on the coarsest level.
+    :param c_robust: hyperparameter to suppress radius around a feature point.
+    :param match_threshold: Ratio threshold of match_feature on the coarsest
+        level. Defaults to the threshold of the descriptor type (see
+        default_threshold).
+    :param window_threshold: Ratio threshold of the matchings within search
+        windows on finer levels: the best location is kept only if its
+        distance is below window_threshold times the distance of the best
+        location outside its 3x3 neighborhood. Neighboring locations have
+        correlated descriptors, so this is looser than match_threshold.
+    :param ransac_threshold: Inlier threshold of ransac.
+    :param max_iter: Number of iterations of ransac on the coarsest level.
+    :param refine_iter: Maximum number of iterations of ransac on finer
+        levels.
+    :param seed: Seed of the random number generator of ransac.
+    :param descriptor_mode: "float", "float16", "int8" or "binary"
+        descriptors on every level (see extract_descriptor).
+    :param cache: Optional FeatureCache of the features of the coarsest
+        levels. Counts are kept in the calling process only, so in an
+        executor of processes, look the features up with
+        pyramid_features_all and pass them as features1 and features2.
+    :param ransac_confidence: Confidence of the adaptive termination of
+        ransac on the coarsest level (see match_pair).
+    :param prosac: If True, ransac on the coarsest level samples the best
+        scored matchings first (see match_pair).
+    :param features1: Optional features of the coarsest level of image 1,
+        as returned by pyramid_features with the same parameters. Found
+        (and cached) if not given.
+    :param features2: Optional features of the coarsest level of image 2.
+    """
+    check_confidence(ransac_confidence)
+    params = dict(num_levels = num_levels, downscale = downscale,
+        max_pts = max_pts, c_robust = c_robust,
+        descriptor_mode = descriptor_mode)
+    pyramid1, coords1, descriptor1 = _cached_pyramid(im1, features1, params,
+        cache)
+    pyramid2, coords2, descriptor2 = _cached_pyramid(im2, features2, params,
+        cache)
+
+    # Full registration on the coarsest level.
+    if match_threshold is None:
+        match_threshold = default_threshold(descriptor1)
+    im1_coords, im2_coords, scores = match_feature(descriptor1, descriptor2,
+        coords1, coords2, match_threshold, return_scores = True)
+    try:
+        H, inlier = ransac(im1_coords, im2_coords, max_iter = max_iter,
+            threshold = ransac_threshold, seed = seed,
+            confidence = ransac_confidence,
+            scores = scores if prosac else None)
+    except ValueError:
+        return None, 0
+    num_inliers = int(np.sum(inlier))
+
+    # Refine on each finer level by matching around predicted locations.
+    for level in range(len(pyramid1) - 2, -1, -1):
+        A1 = level_transform(pyramid1[level].shape, pyramid1[level + 1].shape)
+        A2 = level_transform(pyramid2[level].shape, pyramid2[level + 1].shape)
+        H = np.dot(np.linalg.inv(A2), np.dot(H, A1))
+        coords1 = _apply(np.linalg.inv(A1), coords1)
+        im1_coords, im2_coords = match_window(pyramid1[level],
+            pyramid2[level], coords1, H, radius, window_threshold,
+            descriptor_mode)
+        try:
+            H, inlier = ransac(im1_coords, im2_coords, max_iter = refine_iter,
+                threshold = ransac_threshold, seed = seed, confidence = 0.99)
+        except ValueError:
+            # Keep the transformation of the coarser level.
+            continue
+        num_inliers = int(np.sum(inlier))
+    return H / H[2, 2], num_inliers
+
+
+def level_transform(shape_fine, shape_coarse):
+    """
+    Transformation matrix from pixel coordinates of a pyramid level to those
+    of the next coarser level.
+    :param shape_fine: Shape of the finer level.
+    :param shape_coarse: Shape of the coarser level.
+    """
+    scale_r = shape_coarse[0] / shape_fine[0]
+    scale_c = shape_coarse[1] / shape_fine[1]
+    return np.array([[scale_r, 0, 0.5 * scale_r - 0.5],
+        [0, scale_c, 0.5 * scale_c - 0.5], [0, 0, 1]])
+
+
+def _cached_pyramid(im, features, params, cache):
+    """
+    Build the pyramid of an image and find the features of its coarsest
+    level, unless they are given, looking them up in the cache first if
+    there is one. Returns the pyramid, the feature point locations and their
+    descriptors.
+    """
+    if features is None and cache is not None:
+        key = _cache_key(cache, im, params)
+        entry = cache.get(key, ("coords", "descriptor"))
+        if entry is not None:
+            features = entry["coords"], entry["descriptor"]
+    im = skio.imread(im) if isinstance(im, str) else im
+    pyramid = build_pyramid(im, params["num_levels"], params["downscale"])
+    if features is None:
+        features = _features(pyramid[-1], params["max_pts"],
+            params["c_robust"], params["descriptor_mode"])
+        if cache is not None:
+            cache.put(key, coords = features[0], descriptor = features[1])
+    return (pyramid,) + tuple(features)
+
+
+def _cache_key(cache, im, params):
+    """
+    Cache key of the features of the coarsest level of an image, on every
+    parameter of pyramid_features and the defaults of the stages it runs.
+    """
+    return cache.key(im, stage = "pyramid", **params, **default_params(
+        get_harris_corners, non_max_suppression, extract_descriptor))
+
+
+def _features(im, max_pts, c_robust, descriptor_mode = "float"):
+    """
+    Find the feature points of a pyramid level and extract their descriptors.
+    """
+    h, coords = get_harris_corners(im)
+    coords = non_max_suppression(h, coords, max_pts = max_pts,
+        c_robust = c_robust)
+    return coords, extract_descriptor(im, coords, mode = descriptor_mode)
+
+
+def _apply(H, coords):
+    """
+    Transform pixel locations of shape (2, n) by H, rounded to integers.
+    """
+    coords_trans = np.dot(H, np.concatenate((coords,
+        np.ones((1, coords.shape[1])))))
+    return np.rint(coords_trans[:2] / coords_trans[2]).astype(int)
+
+
+def match_window(im1, im2, im1_coords, H, radius, threshold = 0.8,
+    descriptor_mode = "float", patch_size = 40):
+    """
+    Match each feature point of image 1 to the pixel of image 2 within radius
+    of its location predicted by H whose descriptor is closest, refined to
+    sub-pixel precision. Matchings whose best distance is not below
+    threshold times the best distance outside the 3x3 neighborhood of the
+    best pixel are ambiguous and dropped, as are points whose descriptors or
+    search windows do not fit in the images. Returns the matched feature
+    point locations in image 1 and image 2.
+    :param im1: Grayscale image 1.
+    :param im2: Grayscale image 2.
+    :param im1_coords: Feature point locations in image 1.
+    :param H: Transformation matrix predicting locations in image 2.
+    :param radius: Search radius in pixels around the predicted locations.
+    :param threshold: Ratio threshold of the ambiguity test.
+    :param descriptor_mode: Descriptor mode (see extract_descriptor).
+    :param patch_size: Height and width of the descriptor patches.
+    """
+    margin = patch_size // 2
+    im1_coords = np.rint(im1_coords).astype(int)
+    predicted = _apply(H, im1_coords)
+    keep = np.all((im1_coords >= margin) &
+        (im1_coords < np.array(im1.shape)[:, np.newaxis] - margin), axis = 0)
+    keep &= np.all((predicted >= margin + radius) &
+        (predicted < np.array(im2.shape)[:, np.newaxis] - margin - radius),
+        axis = 0)
+    im1_coords, predicted = im1_coords[:, keep], predicted[:, keep]
+    num_pts = im1_coords.shape[1]
+    if num_pts == 0:
+        return im1_coords, predicted.astype(float)
+
+    # Descriptors of every pixel in the search window of every point.
+    offsets = np.arange(-radius, radius + 1)
+    offset_rr, offset_cc = np.meshgrid(offsets, offsets, indexing = "ij")
+    offsets = np.stack((offset_rr.ravel(), offset_cc.ravel()))
+    num_offsets = offsets.shape[1]
+    candidates = predicted[:, :, np.newaxis] + offsets[:, np.newaxis, :]
+    descriptor1 = extract_descriptor(im1, im1_coords, mode = descriptor_mode)
+    descriptor2 = extract_descriptor(im2, candidates.reshape((2, -1)),
+        mode = descriptor_mode)
+    dist = pair_distances(descriptor1.reshape((num_pts, -1)),
+        descriptor2.reshape((num_pts * num_offsets, -1)),
+        np.repeat(np.arange(num_pts), num_offsets),
+        np.arange(num_pts * num_offsets))
+    dist = dist.reshape((num_pts, num_offsets))
+    best = np.argmin(dist, axis = 1)
+    best_dist = dist[np.arange(num_pts), best]
+
+    # Ratio test against the best pixel outside the 3x3 neighborhood of the
+    # best one, whose descriptors are nearly the same.
+    far = np.max(np.abs(offsets[:, np.newaxis, :] -
+        offsets[:, best][:, :, np.newaxis]), axis = 0) > 1
+    second_dist = np.min(np.where(far, dist, np.inf), axis = 1)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        mask = best_dist / second_dist < threshold
+    im1_coords, best = im1_coords[:, mask], best[mask]
+    dist = dist[mask].reshape((-1, 2 * radius + 1, 2 * radius + 1))
+    num_pts = len(best)
+
+    # Fit a parabola along each axis through the best distance and its two
+    # neighbors, and move to its minimum. Best pixels on the border of the
+    # window stay where they are.
+    im2_coords = candidates[:, mask][:, np.arange(num_pts), best].astype(float)
+    best_rc = np.unravel_index(best, dist.shape[1:])
+    for axis in range(2):
+        interior = (best_rc[axis] > 0) & (best_rc[axis] < 2 * radius)
+        pts = np.flatnonzero(interior)
+        rc = [best_rc[0][pts], best_rc[1][pts]]
+        dist_mid = dist[pts, rc[0], rc[1]]
+        rc[axis] = rc[axis] - 1
+        dist_low = dist[pts, rc[0], rc[1]]
+        rc[axis] = rc[axis] + 2
+        dist_high = dist[pts, rc[0], rc[1]]
+        curvature = dist_low - 2 * dist_mid + dist_high
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            shift = 0.5 * (dist_low - dist_high) / curvature
+        shift = np.where(curvature > 0, np.clip(shift, -0.5, 0.5), 0)
+        im2_coords[axis, pts] += shift
+    return im1_coords, im2_coords
@@ -7,12 +7,19 @@ from harris import get_harris_corners
 from harris import dist2
 from descriptor_extraction import extract_descriptor
 from feature_matching import match_feature
-from compute_projection import computeH
+from compute_projection import computeH_normalized, refine_homography
+from profiling import profiled, count
 
-def ransac(im1_coords, im2_coords, max_iter = 500, threshold = 4):
+@profiled("ransac")
+def ransac(im1_coords, im2_coords, max_iter = 500, threshold = 4,
+    batch_size = 256, seed = None, confidence = None, scores = None,
+    pre_verify = 0, refine = True):
     """
     Implementation of RANSAC algorithm to find the affine transformation matrix
-    between from image 1 to image 2.
+    between from image 1 to image 2. Hypotheses are drawn and scored in
+    batches against every matching.
+    Returns the best transformation matrix, refit on all of its inliers, and
+    a boolean mask of the inliers.
     :param im1_coords: Feature points in image 1 that have valid matchings.
     :param im2_coords: Feature points in image 2 that have valid matchings.
     :param max_iter: Maximum number of iterations of homography-validation cycle.
@@ -20,56 +27,196 @@ def ransac(im1_coords, im2_coords, max_iter = 500, threshold = 4):
     :param threshold: Constraint on inliers. A point would be considered as an
         inlier if the squared distance between its transformed coordinate and
         its matching feature location in image 2 is less than 4.
+    :param batch_size: Number of hypotheses scored together. Bounds the
+        (batch_size, num of matchings) arrays held in memory.
+    :param seed: Seed of the random number generator.
+    :param confidence: If given, stop as soon as the number of iterations
+        needed to find an all-inlier sample with this probability, estimated
+        from the current best inlier ratio, has been reached.
+    :param scores: Optional quality of each matching, lower is better (e.g.
+        the ratio returned by match_feature). If given, samples are drawn
+        progressively from the best matchings first (PROSAC).
+    :param pre_verify: If positive, each hypothesis is first checked on this
+        many random matchings, and only scored on all matchings if they are
+        all inliers (the T(d,d) test).
+    :param refine: If True, the transformation refit on the inliers is
+        polished with Levenberg-Marquardt (see refine_homography).
     """
-    # Initialize number of best matches to keep track of the best affine
-    # transformation matrix computer so far.
-    # Initialize best_im1_coords_inlier and best_im2_coords_inlier to record
-    # inlier points in image 1 (resp. image 2) corresponding to the best affine
-    # transformation matrix.
+    num_pts = im1_coords.shape[1]
+    if num_pts < 4:
+        raise ValueError("RANSAC needs at least 4 matchings, got " +
+            f"{num_pts}.")
+    check_confidence(confidence)
+    rng = np.random.default_rng(seed)
+
+    # Sort the matchings from best to worst for progressive sampling.
+    if scores is not None:
+        order = np.argsort(scores, kind = "stable")
+        im1_coords = im1_coords[:, order]
+        im2_coords = im2_coords[:, order]
+        pool_sizes = _prosac_pool_sizes(num_pts, max_iter)
+
+    im1_coords_add1 = np.concatenate((im1_coords, np.ones((1, num_pts))))
     best_num_matches = 0
-    best_im1_coords_inlier = None
-    best_im2_coords_inlier = None
-
-    for i in range(max_iter):
-        # Choose four points randomly from image 1 and image 2 to compute a
-        # candidate affine transformation matrix.
-        indices = np.random.choice(im1_coords.shape[1], size = 4, replace = False)
-        im1_pts = im1_coords[:, indices]
-        im2_pts = im2_coords[:, indices]
-        H = computeH(im1_pts.T, im2_pts.T)
-
-        # Transform feature points in image 1 according to the computer affine
-        # transformation matrix.
-        im1_coords_add1 = np.concatenate((im1_coords,
-            np.ones((1, im1_coords.shape[1]))))
-        im1_coords_trans = np.dot(H, im1_coords_add1)
-        im1_coords_trans = (im1_coords_trans / im1_coords_trans[2])[:2]
-
-        # Compute the distance between each transformed feature location and
-        # target feature location. Discard the points that are too far away.
-        dist = np.sum((im1_coords_trans - im2_coords) ** 2, axis = 0)
-        num_matches = np.sum((dist < threshold).astype(int))
-        im1_coords_inlier = im1_coords[:, dist < threshold]
-        im2_coords_inlier = im2_coords[:, dist < threshold]
-
-        # Updata tracking records if necessary.
-        if num_matches > best_num_matches:
-            best_im1_coords_inlier = im1_coords_inlier
-            best_im2_coords_inlier = im2_coords_inlier
-            best_num_matches = num_matches
-
-    # Interactive interface. User will decide whether to continue the sampling
-    # and calculation process.
-    print("Current best number of matches: ", best_num_matches)
-    print("Are you satisfied? [Y/N]")
-    satisfied = input()
-    if satisfied == "N":
-        print("How many more iterations do you want to try?")
-        max_iter = int(input())
-        print("What threshold do you want to set?")
-        threshold = float(input())
-        print("Going back...")
-        ransac(im1_coords, im2_coords, max_iter = max_iter, threshold = threshold)
-    else:
-        best_H = computeH(best_im1_coords_inlier.T, best_im2_coords_inlier.T)
-        return best_H
+    best_mask = None
+    num_iter = max_iter
+    start = 0
+    while start < num_iter:
+        num_samples = min(batch_size, num_iter - start)
+        # Choose four points randomly from image 1 and image 2 for every
+        # hypothesis, and compute the candidate affine transformation
+        # matrices.
+        if scores is None:
+            indices = _sample_indices(rng, num_pts, num_samples)
+        else:
+            indices = _sample_indices_prosac(rng,
+                pool_sizes[start: start + num_samples])
+        H = computeH_normalized(im1_coords.T[indices], im2_coords.T[indices])
+        start += num_samples
+
+        # Discard hypotheses that fail on a few random matchings before
+        # scoring them on all matchings.
+        if pre_verify > 0:
+            check = rng.integers(num_pts, size = (num_samples, pre_verify))
+            passed = np.all(score_hypotheses(H,
+                np.moveaxis(im1_coords_add1[:, check], 1, 0),
+                np.moveaxis(im2_coords[:, check], 1, 0), threshold), axis = 1)
+            H = H[passed]
+            if H.shape[0] == 0:
+                continue
+
+        # Keep track of the hypothesis with the most inliers.
+        inlier = score_hypotheses(H, im1_coords_add1, im2_coords, threshold)
+        num_matches = np.sum(inlier, axis = 1)
+        best = np.argmax(num_matches)
+        if num_matches[best] > best_num_matches:
+            best_num_matches = num_matches[best]
+            best_mask = inlier[best]
+            if confidence is not None:
+                num_iter = _required_iterations(best_num_matches / num_pts,
+                    confidence, 4 + pre_verify, max_iter)
+
+    count("iterations", start)
+    count("inliers", best_num_matches)
+    if best_num_matches < 4:
+        raise ValueError("RANSAC found no homography with at least 4 inliers.")
+    im1_inliers = im1_coords[:, best_mask].T
+    im2_inliers = im2_coords[:, best_mask].T
+    best_H = computeH_normalized(im1_inliers[np.newaxis],
+        im2_inliers[np.newaxis])[0]
+    if refine:
+        best_H = refine_homography(best_H, im1_inliers, im2_inliers)
+    # A degenerate inlier set (e.g. collinear points) has no unique fit.
+    if not np.all(np.isfinite(best_H)):
+        raise ValueError("RANSAC inliers are degenerate, the homography " +
+            "refit on them is not finite.")
+    if scores is not None:
+        # Put the inlier mask back into the order of the input matchings.
+        mask = np.empty(num_pts, dtype = bool)
+        mask[order] = best_mask
+        best_mask = mask
+    return best_H, best_mask
+
+
+def check_confidence(confidence):
+    """
+    Raise ValueError unless confidence is None or strictly between 0 and 1.
+    Callers that catch the ValueError of ransac for unregistrable pairs
+    check it first, so that a bad confidence is not taken for one.
+    :param confidence: Confidence of the adaptive termination of ransac.
+    """
+    if confidence is not None and not 0 < confidence < 1:
+        raise ValueError("RANSAC confidence must be strictly between 0 and " +
+            f"1, got {confidence}.")
+
+
+def score_hypotheses(H, im1_coords_add1, im2_coords, threshold):
+    """
+    Find the inliers of a batch of transformation matrices.
+    Output shape: (num of matrices, num of matchings)
+    :param H: Transformation matrices, of shape (K, 3, 3).
+    :param im1_coords_add1: Homogeneous feature points in image 1, of shape
+        (3, N), or (K, 3, N) to check different points for each matrix.
+    :param im2_coords: Feature points in image 2, of shape (2, N) or
+        (K, 2, N).
+    :param threshold: Constraint on the squared distance of inliers.
+    """
+    # Transform feature points in image 1 according to every matrix, and
+    # compute the distance between each transformed feature location and
+    # target feature location.
+    im1_coords_trans = np.matmul(H, im1_coords_add1)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        im1_coords_trans = im1_coords_trans[:, :2] / im1_coords_trans[:, 2:]
+        dist = np.sum((im1_coords_trans - im2_coords) ** 2, axis = 1)
+    # NaN distances (from singular samples) are never inliers.
+    return dist < threshold
+
+
+def _required_iterations(inlier_ratio, confidence, num_required, max_iter):
+    """
+    Number of iterations needed so that, with probability confidence, at
+    least one hypothesis is drawn from and checked on num_required inliers,
+    capped at max_iter.
+    """
+    good = inlier_ratio ** num_required
+    if good >= 1:
+        return 0
+    if good <= 0:
+        return max_iter
+    # The ratio is a finite positive float for 0 < confidence < 1 and
+    # 0 < good < 1, but may be huge; cap it before the integer cast.
+    num_iter = np.ceil(np.log(1 - confidence) / np.log1p(-good))
+    return int(min(num_iter, max_iter))
+
+
+def _sample_indices(rng, num_pts, num_samples, sample_size = 4):
+    """
+    Draw num_samples sets of sample_size distinct indices in
+    range(num_pts). num_pts may also be an array giving the range of each
+    set. Output shape: (num_samples, sample_size)
+    """
+    num_pts = np.broadcast_to(num_pts, (num_samples,))[:, np.newaxis]
+    indices = (rng.random((num_samples, sample_size)) * num_pts).astype(int)
+    while True:
+        # Redraw the sets that contain a repeated index.
+        indices_sorted = np.sort(indices, axis = 1)
+        repeated = np.any(indices_sorted[:, 1:] == indices_sorted[:, :-1],
+            axis = 1)
+        if not np.any(repeated):
+            return indices
+        indices[repeated] = (rng.random((np.sum(repeated), sample_size)) *
+            num_pts[repeated]).astype(int)
+
+
+def _prosac_pool_sizes(num_pts, max_iter, sample_size = 4):
+    """
+    Size of the pool of best matchings that PROSAC samples from at each
+    iteration. The pool grows from sample_size to num_pts so that, after
+    max_iter iterations, every matching has been sampled about as often as
+    in RANSAC.
+    """
+    # T[n] is the expected number of samples drawn from the n best matchings
+    # among max_iter samples drawn from all matchings.
+    n = np.arange(sample_size, num_pts + 1)
+    log_ratio = np.zeros(len(n))
+    for i in range(sample_size):
+        log_ratio += np.log(n - i) - np.log(num_pts - i)
+    T = max_iter * np.exp(log_ratio)
+    # The n best matchings form the pool until iteration T'[n].
+    T_prime = np.cumsum(np.maximum(np.ceil(np.diff(T, prepend = 0)), 1))
+    pool_sizes = n[np.minimum(np.searchsorted(T_prime,
+        np.arange(1, max_iter + 1)), len(n) - 1)]
+    return pool_sizes
+
+
+def _sample_indices_prosac(rng, pool_sizes, sample_size = 4):
+    """
+    Draw one PROSAC sample for each pool size: the worst matching of the pool
+    together with sample_size - 1 distinct matchings drawn from the rest of
+    the pool. Output shape: (len(pool_sizes), sample_size)
+    """
+    indices = np.empty((len(pool_sizes), sample_size), dtype = int)
+    indices[:, :-1] = _sample_indices(rng, pool_sizes - 1, len(pool_sizes),
+        sample_size - 1)
+    indices[:, -1] = pool_sizes - 1
+    return indices
@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+from composite import composite
+from pipeline import detect_and_describe, match_pair, load_image
+from profiling import Profiler
+from descriptor_extraction import extract_descriptor
+from benchmark import environment
+
+# Directory of the bundled images and correspondences.
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Bundled pairs: name, image files, manual correspondences of the left and
+# right image (rows of (row, col), as saved by mosaic.py), number of feature
+# points retained by non-max suppression, c_robust, and the minimum number
+# of RANSAC inliers accepted. Relative paths are in DATA_DIR.
+REGRESSION_PAIRS = [
+    ("mosaic3", ["mosaic3_left.jpeg", "mosaic3_right.jpeg"],
+        ["left_im_pts_3.csv", "right_im_pts_3.csv"], 2000, 0.8, 430),
+    ("mosaic4", ["mosaic4_left.jpeg", "mosaic4_right.jpeg"],
+        ["left_im_pts_4.csv", "right_im_pts_4.csv"], 1000, 0.75, 80),
+    ("mosaic7", ["mosaic7_left.jpeg", "mosaic7_right.jpeg"],
+        ["left_im_pts_5.csv", "right_im_pts_5.csv"], 1500, 0.8, 100),
+]
+
+
+def reprojection_error(H, im1_pts, im2_pts):
+    """
+    Distances between the points of image 1 transformed by H and their
+    corresponding points in image 2.
+    :param H: Projective transformation matrix from image 1 to image 2.
+    :param im1_pts: Points in image 1, of shape (n, 2).
+    :param im2_pts: Points in image 2, of shape (n, 2).
+    """
+    im1_pts_trans = np.dot(H, np.concatenate((im1_pts.T,
+        np.ones((1, im1_pts.shape[0])))))
+    im1_pts_trans = im1_pts_trans[:2] / im1_pts_trans[2]
+    return np.linalg.norm(im1_pts_trans.T - im2_pts, axis = 1)
+
+
+def run_pair(files, csv_files, max_pts, c_robust, seed = 0, memory = True):
+    """
+    Register and composite one bundled pair headlessly and deterministically.
+    Returns a result with the number of matchings and inliers, the
+    reprojection error of the automatic transformation on the manual
+    correspondences, the transformation, and the wall time, CPU time and
+    peak memory of every stage.
+    :param files: Image files of the left and right image, relative to
+        DATA_DIR.
+    :param csv_files: Manual correspondences of the left and right image,
+        relative to DATA_DIR.
+    :param max_pts: Number of feature points retained by non-max suppression.
+    :param c_robust: hyperparameter to suppress radius around a feature point.
+    :param seed: Seed of the random number generator of ransac.
+    :param memory: If True, trace the peak memory of every stage.
+    """
+    im1, im2 = [load_image(os.path.join(DATA_DIR, file)) for file in files]
+    start = time.perf_counter()
+    with Profiler(memory = memory) as profiler:
+        features1 = detect_and_describe(im1, max_pts = max_pts,
+            c_robust = c_robust)
+        features2 = detect_and_describe(im2, max_pts = max_pts,
+            c_robust = c_robust)
+        H, num_inliers, num_matches = match_pair(features1, features2,
+            seed = seed, return_num_matches = True)
+        if H is not None:
+            composite([im1, im2], [np.eye(3), H])
+    wall_time = time.perf_counter() - start
+
+    result = {"matches": num_matches, "inliers": num_inliers,
+        "wall_time": wall_time, "stages": profiler.summary(),
+        "H": None if H is None else H.tolist()}
+    if H is not None:
+        im1_pts, im2_pts = [np.loadtxt(os.path.join(DATA_DIR, file),
+            delimiter = ",") for file in csv_files]
+        error = reprojection_error(H, im1_pts, im2_pts)
+        result["reprojection_error_mean"] = float(np.mean(error))
+        result["reprojection_error_max"] = float(np.max(error))
+    return result
+
+
+def check_border_descriptors(file = REGRESSION_PAIRS[0][1][0],
+    min_correlation = 0.95, patch_size = 40):
+    """
+    Check descriptors of feature points at the image border: points exactly
+    half a patch from every border must give batch descriptors that agree
+    with the per-patch method = "resize" (mean correlation of at least
+    min_correlation), and points one pixel closer must raise ValueError with
+    every method and mode. Returns a result with a "passed" flag and the
+    list of failed gates.
+    :param file: Image file, relative to DATA_DIR.
+    :param min_correlation: Minimum mean correlation between the batch and
+        resize descriptors of the same points.
+    :param patch_size: Height and width of the descriptor patches.
+    """
+    im = load_image(os.path.join(DATA_DIR, file))
+    im = im[:, :, 0] if len(im.shape) == 3 else im
+    half = patch_size // 2
+    r_max, c_max = im.shape[0] - half, im.shape[1] - half
+    # Points along all four borders, at the closest allowed distance.
+    rr = np.linspace(half, r_max, 20).astype(int)
+    cc = np.linspace(half, c_max, 20).astype(int)
+    coords = np.concatenate((np.stack((rr, np.full(20, half))),
+        np.stack((rr, np.full(20, c_max))), np.stack((np.full(20, half), cc)),
+        np.stack((np.full(20, r_max), cc))), axis = 1)
+    batch, resize = [extract_descriptor(im, coords, patch_height = patch_size,
+        patch_width = patch_size, method = method).reshape(
+        coords.shape[1], -1) for method in ("batch", "resize")]
+    correlation = float(np.mean([np.corrcoef(x, y)[0, 1]
+        for x, y in zip(batch, resize)]))
+    failures = []
+    if not correlation >= min_correlation:
+        failures.append(f"border correlation {correlation:.3f} < " +
+            f"{min_correlation}")
+    for point in ([half - 1, half], [r_max + 1, half], [half, half - 1],
+        [half, c_max + 1]):
+        for method, mode in (("batch", "float"), ("resize", "float"),
+            ("batch", "int8"), ("batch", "binary")):
+            try:
+                extract_descriptor(im, np.array(point)[:, np.newaxis],
+                    patch_height = patch_size, patch_width = patch_size,
+                    method = method, mode = mode)
+            except ValueError:
+                continue
+            failures.append(f"no error for {point} with {method}/{mode}")
+    return {"correlation": correlation, "passed": not failures,
+        "failures": failures}
+
+
+def run_regression(pairs = REGRESSION_PAIRS, seed = 0, max_error = 8,
+    memory = True, log = None):
+    """
+    Run every bundled pair and check the quality gates: the pair must be
+    registered with at least its minimum number of inliers, and the mean
+    reprojection error on the manual correspondences must be at most
+    max_error pixels. The manual points themselves are only accurate to a
+    few pixels. Returns the results of all pairs, keyed by name, each with
+    a "passed" flag and the list of failed gates.
+    :param pairs: Pairs to run, as in REGRESSION_PAIRS.
+    :param seed: Seed of the random number generator of ransac.
+    :param max_error: Maximum mean reprojection error in pixels.
+    :param memory: If True, trace the peak memory of every stage.
+    :param log: Optional file to report progress to.
+    """
+    results = {}
+    for name, files, csv_files, max_pts, c_robust, min_inliers in pairs:
+        result = run_pair(files, csv_files, max_pts, c_robust, seed = seed,
+            memory = memory)
+        failures = []
+        if result["inliers"] < min_inliers:
+            failures.append(f"{result['inliers']} inliers < {min_inliers}")
+        error = result.get("reprojection_error_mean", np.inf)
+        if not error <= max_error:
+            failures.append(f"reprojection error {error:.2f} > {max_error}")
+        result["passed"] = not failures
+        result["failures"] = failures
+        results[name] = result
+        if log is not None:
+            print(f"{name}: {'ok' if not failures else 'FAILED'} "
+                f"({result['inliers']} inliers, error {error:.2f} px, "
+                f"{result['wall_time']:.2f} s) " + "; ".join(failures),
+                file = log)
+    return results
+
+
+def main(argv = None):
+    """
+    Command-line entry point: run the regression benchmark, write the
+    results as JSON, and exit with a non-zero status if a gate fails.
+    """
+    parser = argparse.ArgumentParser(description = "Deterministic end-to-end "
+        "regression benchmark on the bundled mosaic pairs.")
+    parser.add_argument("-o", "--output", required = True,
+        help = "path of the JSON results")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--max-error", type = float, default = 8,
+        help = "maximum mean reprojection error in pixels")
+    parser.add_argument("--no-memory", action = "store_true",
+        help = "do not trace memory (faster, no peak memory)")
+    args = parser.parse_args(argv)
+
+    results = run_regression(seed = args.seed, max_error = args.max_error,
+        memory = not args.no_memory, log = sys.stderr)
+    border = check_border_descriptors()
+    print(f"border descriptors: {'ok' if border['passed'] else 'FAILED'} " +
+        f"(correlation {border['correlation']:.3f}) " +
+        "; ".join(border["failures"]), file = sys.stderr)
+    results["border_descriptors"] = border
+    with open(args.output, "w") as f:
+        json.dump({"environment": environment(), "seed": args.seed,
+            "results": results}, f, indent = 2)
+    return 0 if all(result["passed"] for result in results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+import numpy as np
+from composite import panorama_bounds, blend_into
+from pipeline import detect_and_describe, match_pair, to_gray
+from pyramid import match_window
+from ransac import ransac
+
+
+class StreamStitcher:
+    """
+    Stitch the frames of a moving camera one at a time into a growing
+    panorama, in the plane of the first frame. The feature points of the
+    previous frame are tracked into each new frame: the motion between the
+    two frames is predicted from the previous motion, each point is matched
+    within radius pixels of its predicted location, and a short RANSAC
+    estimates the motion. Full detection and matching only run when
+    tracking fails, and new points are detected when too few are left.
+    :param max_pts: Number of feature points retained by non-max suppression.
+    :param c_robust: hyperparameter to suppress radius around a feature point.
+    :param match_threshold: Ratio threshold of match_feature when matching
+        fully.
+    :param ransac_threshold: Inlier threshold of ransac.
+    :param max_iter: Number of iterations of ransac when matching fully.
+    :param refine_iter: Maximum number of iterations of ransac when tracking.
+    :param radius: Search radius in pixels around predicted locations.
+    :param min_inliers: Minimum number of inliers for a frame to be
+        registered.
+    :param max_tracked: Number of points tracked from frame to frame. The
+        first ones are kept, which non-max suppression spreads over the
+        frame.
+    :param min_tracked: New points are detected when fewer are tracked.
+    :param blend: Blending mode of composite, or None to only estimate the
+        transformations without compositing.
+    :param feather_width: width in pixels of the feathering ramp.
+    :param seed: Seed of the random number generator of ransac.
+    """
+
+    def __init__(self, max_pts = 1000, c_robust = 0.9, match_threshold = 0.27,
+        ransac_threshold = 4, max_iter = 500, refine_iter = 100, radius = 5,
+        min_inliers = 20, max_tracked = 200, min_tracked = 100,
+        blend = "feather", feather_width = 20, seed = None):
+        self.max_pts = max_pts
+        self.c_robust = c_robust
+        self.match_threshold = match_threshold
+        self.ransac_threshold = ransac_threshold
+        self.max_iter = max_iter
+        self.refine_iter = refine_iter
+        self.radius = radius
+        self.min_inliers = min_inliers
+        self.max_tracked = max_tracked
+        self.min_tracked = min_tracked
+        self.blend = blend
+        self.feather_width = feather_width
+        self.seed = seed
+        # For every frame, the reversed projective transformation from the
+        # plane of the first frame to it, or None if it was not registered.
+        self.homographies = []
+        # Number of frames registered by tracking, by full matching, and
+        # not registered.
+        self.stats = {"tracked": 0, "matched": 0, "failed": 0}
+        self._previous = None
+        self._points = None
+        self._features = None
+        self._motion = None
+        self._H = np.eye(3)
+        self._canvas = None
+        self._covered = None
+        self._origin = None
+        self._bounds = None
+
+    def add(self, frame):
+        """
+        Register a frame to the previous registered one and blend it into
+        the panorama. Returns the reversed projective transformation from
+        the plane of the first frame to the frame, or None if the frame
+        could not be registered (it is then skipped).
+        :param frame: Next frame of the stream.
+        """
+        gray = to_gray(frame)
+        if self._previous is None:
+            self._features = self._detect(gray)
+            self._points = self._features[0]
+            return self._accept(frame, gray, np.eye(3))
+
+        H_step = self._track(gray)
+        if H_step is not None:
+            self.stats["tracked"] += 1
+        else:
+            H_step = self._match(gray)
+            if H_step is None:
+                self.stats["failed"] += 1
+                self.homographies.append(None)
+                return None
+            self.stats["matched"] += 1
+        if self._points.shape[1] < self.min_tracked:
+            self._features = self._detect(gray)
+            self._points = self._features[0]
+        self._motion = H_step
+        H = np.dot(H_step, self._H)
+        return self._accept(frame, gray, H / H[2, 2])
+
+    def panorama(self):
+        """
+        Returns the panorama so far and the offset (r_min, c_min) of its
+        top-left pixel in the plane of the first frame, or (None, None) if
+        no frame was composited (blend is None, or no frame was added).
+        """
+        if self._bounds is None:
+            return None, None
+        r_min, r_max, c_min, c_max = self._bounds
+        r0, c0 = r_min - self._origin[0], c_min - self._origin[1]
+        return self._canvas[r0: r0 + r_max - r_min, c0: c0 + c_max - c_min], \
+            (r_min, c_min)
+
+    def _detect(self, gray):
+        """
+        Find the feature points of a frame and extract their descriptors.
+        """
+        return detect_and_describe(gray, max_pts = self.max_pts,
+            c_robust = self.c_robust)
+
+    def _track(self, gray):
+        """
+        Track the points of the previous frame into this one, predicting
+        their locations with the previous motion. Returns the motion from
+        the previous frame to this one, or None if tracking fails (also
+        when there is no previous motion yet). The tracked points become
+        the points of this frame.
+        """
+        if self._motion is None or self._points.shape[1] < 4:
+            return None
+        im1_coords, im2_coords = match_window(self._previous, gray,
+            self._points[:, :self.max_tracked], self._motion, self.radius)
+        try:
+            H_step, inlier = ransac(im1_coords, im2_coords,
+                max_iter = self.refine_iter, threshold = self.ransac_threshold,
+                seed = self.seed, confidence = 0.99)
+        except ValueError:
+            return None
+        # Most tracked points must agree, otherwise the prediction was off.
+        num_inliers = np.sum(inlier)
+        if num_inliers < max(self.min_inliers, inlier.shape[0] // 2):
+            return None
+        self._points = im2_coords[:, inlier]
+        self._features = None
+        return H_step
+
+    def _match(self, gray):
+        """
+        Match the full features of the previous frame and this one. Returns
+        the motion from the previous frame to this one, or None. The
+        detected points become the points of this frame.
+        """
+        if self._features is None:
+            self._features = self._detect(self._previous)
+        features = self._detect(gray)
+        H_step, num_inliers = match_pair(self._features, features,
+            match_threshold = self.match_threshold,
+            ransac_threshold = self.ransac_threshold,
+            max_iter = self.max_iter, seed = self.seed)
+        if H_step is None or num_inliers < self.min_inliers:
+            return None
+        self._features = features
+        self._points = features[0]
+        return H_step
+
+    def _accept(self, frame, gray, H):
+        """
+        Make a registered frame the previous frame, and blend it into the
+        panorama.
+        """
+        self._previous = gray
+        self._H = H
+        self.homographies.append(H)
+        if self.blend is not None:
+            self._blend(frame, H)
+        return H
+
+    def _blend(self, frame, H):
+        """
+        Blend a frame into the panorama, growing the canvas if needed. The
+        canvas grows by at least half of its size at a time, so that long
+        sweeps are not copied at every frame.
+        """
+        if len(frame.shape) == 2:
+            frame = np.expand_dims(frame, axis = 2)
+        bounds = panorama_bounds([frame], [H])
+        if self._bounds is None:
+            self._bounds = bounds
+            self._origin = (bounds[0], bounds[2])
+            shape = (bounds[1] - bounds[0], bounds[3] - bounds[2])
+            self._canvas = np.zeros(shape + (frame.shape[2],),
+                dtype = frame.dtype)
+            self._covered = np.zeros(shape, dtype = bool)
+        else:
+            self._bounds = (min(self._bounds[0], bounds[0]),
+                max(self._bounds[1], bounds[1]),
+                min(self._bounds[2], bounds[2]),
+                max(self._bounds[3], bounds[3]))
+            self._grow()
+        blend_into(self._canvas, self._covered, self._origin, frame, H,
+            self.blend, self.feather_width, 1)
+
+    def _grow(self):
+        """
+        Reallocate the canvas if the bounds of the panorama exceed it.
+        """
+        height, width = self._covered.shape
+        r_min, r_max, c_min, c_max = self._bounds
+        r0, c0 = self._origin
+        grow_top = max(r0 - r_min, 0)
+        grow_bottom = max(r_max - (r0 + height), 0)
+        grow_left = max(c0 - c_min, 0)
+        grow_right = max(c_max - (c0 + width), 0)
+        if not (grow_top or grow_bottom or grow_left or grow_right):
+            return
+        grow_top, grow_bottom, grow_left, grow_right = [
+            max(grow, size // 2) if grow else 0 for grow, size in
+            zip((grow_top, grow_bottom, grow_left, grow_right),
+            (height, height, width, width))]
+        shape = (height + grow_top + grow_bottom,
+            width + grow_left + grow_right)
+        canvas = np.zeros(shape + self._canvas.shape[2:],
+            dtype = self._canvas.dtype)
+        covered = np.zeros(shape, dtype = bool)
+        canvas[grow_top: grow_top + height,
+            grow_left: grow_left + width] = self._canvas
+        covered[grow_top: grow_top + height,
+            grow_left: grow_left + width] = self._covered
+        self._canvas, self._covered = canvas, covered
+        self._origin = (r0 - grow_top, c0 - grow_left)
+
+
+def stitch_stream(frames, **params):
+    """
+    Stitch all frames of a stream, e.g. a generator reading a video, into one
+    panorama without holding the frames in memory.
+    Returns the panorama, the offset of its top-left pixel in the plane of
+    the first frame (both None if blend is None or frames is empty), and
+    for each frame the reversed projective transformation from the first
+    frame to it (None for frames that could not be registered).
+    :param frames: Iterable of frames.
+    :param params: Parameters of StreamStitcher.
+    """
+    stitcher = StreamStitcher(**params)
+    for frame in frames:
+        stitcher.add(frame)
+    panorama, offset = stitcher.panorama()
+    return panorama, offset, stitcher.homographies
@@ -6,60 +6,252 @@ import skimage.io as skio
 import scipy
 import scipy.spatial as spatial
 import scipy.interpolate as interpolate
+import scipy.ndimage as ndimage
 from compute_projection import computeH
 from define_features import get_points
+from profiling import profiled, count
 
-def warpImage(im, H, shape):
+# Largest condition number of a transformation matrix accepted by warpImage.
+# Homographies between pixel coordinates of real images are around 1e5; past
+# 1e12, fewer than 4 significant digits of the inverse are left in float64.
+MAX_CONDITION = 1e12
+
+@profiled("warp")
+def warpImage(im, H, shape, order = 1, dtype = None, out = None,
+    return_mask = False, tile_size = None):
     """
     Warp an image to another projection plane. Transformation is specified by H.
     Output shape is specified by shape (height * width). In order to account for
     translation, the output shape may not be the same as the input image shape.
-    :param im: image to be warped.
+    The inverse mapping is computed once in float64, and all channels are
+    sampled together with float32 interpolation weights. Only the output
+    pixels inside the bounding box of the projected image are evaluated.
+    Output shape: (shape[0], shape[1], num of channels)
+    :param im: image to be warped. Gray-scale images are treated as having a
+        single channel.
     :param H: the reversed projective transformation from current projection
         plane of im to another projection plane.
     :param shape: output shape.
+    :param order: order of interpolation, 1 for bilinear, 3 for bicubic.
+    :param dtype: data type of the output. Defaults to the data type of im.
+    :param out: optional array of the output shape to warp into, e.g. a
+        numpy.memmap. Only the pixels covered by the warped image are
+        written, the others are left untouched.
+    :param return_mask: if True, also return a boolean mask of the output
+        pixels covered by the warped image.
+    :param tile_size: if given, the output is processed in tiles of
+        tile_size x tile_size pixels, so that the memory used for the inverse
+        mapping and samples scales with the tile size instead of the output
+        size. The result is the same as without tiles.
     """
-    height = im.shape[0]
-    width = im.shape[1]
-    channel = 3
-
     # Handle gray-scale images.
     if len(im.shape) == 2:
-        im1 = np.expand_dims(im, axis = 2)
-        channel = 1
-    elif im.shape[2] == 1:
-        channel = 1
-
-    # Create meshgrid for later interpolation
-    x = np.arange(height)
-    y = np.arange(width)
-
-    output = []
-
-    for i in range(channel):
-        # Create an empty matrix that records the projection result.
-        output_channel = np.zeros((shape[0], shape[1]))
-        im_channel = im[:, :, i]
-        f_im = interpolate.RectBivariateSpline(x, y, im_channel)
-        output_rr, output_cc = np.meshgrid(np.arange(shape[0]),
-            np.arange(shape[1]))
-        # Generate point locations on the resulting image.
-        indices = np.stack((output_rr, output_cc, np.ones(output_cc.shape)),
-            axis = -1)
-        indices_flatten = indices.reshape((-1, 3))
-        # Find the original point locations on the input image using reversed
-        # projection matrix.
-        im_indices = np.dot(H, indices_flatten.T)
-        im_rr, im_cc = im_indices[0, :] / im_indices[2,:], \
-            im_indices[1, :] / im_indices[2, :]
-        # Eliminate the points that are out of boundary.
-        mask_rr = (im_rr >= 0) & (im_rr < height)
-        mask_cc = (im_cc >= 0) & (im_cc < width)
-        mask = mask_rr * mask_cc
-        output_values = f_im(im_rr, im_cc, grid = False) * mask
-        output.append(output_values.reshape((shape[0], shape[1]), order = "F"))
-
-    return np.dstack(output)
+        im = np.expand_dims(im, axis = 2)
+    # Check H before allocating anything.
+    r_start, r_stop, c_start, c_stop = footprint(H, im.shape, shape)
+    if out is None:
+        out = np.zeros((shape[0], shape[1], im.shape[2]),
+            dtype = im.dtype if dtype is None else dtype)
+    elif len(out.shape) == 2:
+        out = np.expand_dims(out, axis = 2)
+    if return_mask:
+        mask_full = np.zeros((shape[0], shape[1]), dtype = bool)
+
+    count("output_pixels", max(r_stop - r_start, 0) * max(c_stop - c_start, 0))
+    if tile_size is None:
+        tile_rows, tile_cols = max(r_stop - r_start, 1), \
+            max(c_stop - c_start, 1)
+    else:
+        tile_rows, tile_cols = tile_size, tile_size
+    # Spline coefficients of bicubic interpolation are shared by all tiles.
+    coefficients = _spline_coefficients(im) if order == 3 else None
+
+    for r0 in range(r_start, r_stop, tile_rows):
+        r1 = min(r0 + tile_rows, r_stop)
+        for c0 in range(c_start, c_stop, tile_cols):
+            c1 = min(c0 + tile_cols, c_stop)
+            values, mask = _warp_block(im, H, np.arange(r0, r1),
+                np.arange(c0, c1), order, coefficients)
+            out_block = out[r0: r1, c0: c1]
+            out_block[mask] = cast_samples(values[mask], out.dtype)
+            if return_mask:
+                mask_full[r0: r1, c0: c1] = mask
+
+    if return_mask:
+        return out, mask_full
+    return out
+
+
+def warpImage_memmap(im, H, shape, filename, tile_size = 1024, order = 1,
+    dtype = None):
+    """
+    Warp an image tile by tile into a memory-mapped .npy file, so that the
+    output never has to fit in memory. The file is created with the output
+    shape and zero-filled outside the warped image. Returns the memory map,
+    which can be reopened later with np.load(filename, mmap_mode = "r").
+    :param im: image to be warped.
+    :param H: the reversed projective transformation from current projection
+        plane of im to another projection plane.
+    :param shape: output shape.
+    :param filename: path of the .npy file to create.
+    :param tile_size: height and width in pixels of the tiles.
+    :param order: order of interpolation, 1 for bilinear, 3 for bicubic.
+    :param dtype: data type of the output. Defaults to the data type of im.
+    """
+    channel = 1 if len(im.shape) == 2 else im.shape[2]
+    out = np.lib.format.open_memmap(filename, mode = "w+",
+        dtype = im.dtype if dtype is None else dtype,
+        shape = (shape[0], shape[1], channel))
+    warpImage(im, H, shape, order = order, out = out, tile_size = tile_size)
+    out.flush()
+    return out
+
+
+def check_homography(H):
+    """
+    Raise ValueError if a transformation matrix cannot be inverted reliably:
+    if it has NaN or infinite entries (e.g. from a degenerate sample of
+    computeH), or if its condition number exceeds MAX_CONDITION.
+    :param H: Transformation matrix, of shape (3, 3).
+    """
+    H = np.asarray(H, dtype = np.float64)
+    if H.shape != (3, 3):
+        raise ValueError("Expected a 3 x 3 transformation matrix, got " +
+            f"shape {H.shape}.")
+    if not np.all(np.isfinite(H)):
+        raise ValueError("Transformation matrix has NaN or infinite entries.")
+    condition = np.linalg.cond(H)
+    if not condition <= MAX_CONDITION:
+        raise ValueError("Transformation matrix is singular or nearly so " +
+            f"(condition number {condition:.3g}).")
+
+
+def footprint(H, im_shape, shape):
+    """
+    Bounding box (r_start, r_stop, c_start, c_stop) of the output pixels that
+    the image lands on, found by projecting its four corners through the
+    inverse of H and clipped to the output shape. Falls back to the whole
+    output if the image crosses the line at infinity. Raises ValueError if H
+    cannot be inverted (see check_homography).
+    :param H: Reversed projection matrix, from output to input locations.
+    :param im_shape: Shape of the input image.
+    :param shape: Shape of the output.
+    """
+    check_homography(H)
+    height, width = im_shape[0], im_shape[1]
+    corners = np.array([[0, 0, height, height], [0, width, 0, width],
+        [1, 1, 1, 1]], dtype = np.float64)
+    corners_trans = np.dot(np.linalg.inv(H), corners)
+    if not (np.all(corners_trans[2] > 0) or np.all(corners_trans[2] < 0)):
+        return 0, shape[0], 0, shape[1]
+    corners_trans = corners_trans[:2] / corners_trans[2]
+    r_start, c_start = np.floor(np.min(corners_trans, axis = 1)).astype(int)
+    r_stop, c_stop = np.ceil(np.max(corners_trans, axis = 1)).astype(int) + 1
+    return max(r_start, 0), min(r_stop, shape[0]), \
+        max(c_start, 0), min(c_stop, shape[1])
+
+
+def _warp_block(im, H, rows, cols, order, coefficients = None):
+    """
+    Sample im at the locations that H maps the grid of output rows and cols
+    to. Returns the float32 samples, of shape (len(rows), len(cols), num of
+    channels), and a boolean mask of the locations inside im.
+    """
+    im_rr, im_cc = inverse_map(H, rows, cols)
+    # Eliminate the points that are out of boundary.
+    mask = (im_rr >= 0) & (im_rr < im.shape[0]) & \
+        (im_cc >= 0) & (im_cc < im.shape[1])
+    return sample_image(im, im_rr, im_cc, order, coefficients), mask
+
+
+def inverse_map(H, rows, cols):
+    """
+    Find the original point locations (im_rr, im_cc) on the input image of
+    the grid of output rows and cols, using reversed projection matrix H.
+    Both are float64 arrays of shape (len(rows), len(cols)): in float32, the
+    projective divide loses about 1e-6 of the output coordinates, i.e. 0.05
+    pixels at 50000 pixels from the origin of the output plane.
+    :param H: Reversed projection matrix, from output to input locations.
+    :param rows: Output rows.
+    :param cols: Output columns.
+    """
+    H = np.asarray(H, dtype = np.float64)
+    rows = np.asarray(rows, dtype = np.float64)[:, np.newaxis]
+    cols = np.asarray(cols, dtype = np.float64)[np.newaxis, :]
+    im_ww = H[2, 0] * rows + H[2, 1] * cols + H[2, 2]
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        im_rr = (H[0, 0] * rows + H[0, 1] * cols + H[0, 2]) / im_ww
+        im_cc = (H[1, 0] * rows + H[1, 1] * cols + H[1, 2]) / im_ww
+    return im_rr, im_cc
+
+
+def sample_image(im, im_rr, im_cc, order, coefficients = None):
+    """
+    Interpolate all channels of im at the locations (im_rr, im_cc).
+    Output shape: im_rr.shape + (num of channels,)
+    :param im: Input image, with a channel axis.
+    :param im_rr: Rows of the locations.
+    :param im_cc: Columns of the locations.
+    :param order: 1 for bilinear, 3 for bicubic interpolation.
+    :param coefficients: for bicubic interpolation, the spline coefficients
+        of im from _spline_coefficients. Computed if not given.
+    """
+    if order == 1:
+        return _bilinear(im, im_rr, im_cc)
+    elif order == 3:
+        if coefficients is None:
+            coefficients = _spline_coefficients(im)
+        values = np.empty(im_rr.shape + (im.shape[2],), dtype = np.float32)
+        for i in range(im.shape[2]):
+            ndimage.map_coordinates(coefficients[i], [im_rr, im_cc],
+                output = values[:, :, i], order = 3, mode = "nearest",
+                prefilter = False)
+        return values
+    raise ValueError(f"Unsupported interpolation order: {order}")
+
+
+def _spline_coefficients(im):
+    """
+    Compute the bicubic spline coefficients of every channel of im.
+    """
+    return [ndimage.spline_filter(im[:, :, i].astype(np.float32), order = 3,
+        mode = "nearest") for i in range(im.shape[2])]
+
+
+def _bilinear(im, im_rr, im_cc):
+    """
+    Bilinearly interpolate all channels of im at the locations (im_rr, im_cc).
+    Locations outside im take the value of the nearest edge pixel.
+    """
+    height, width = im.shape[0], im.shape[1]
+    im_rr = np.nan_to_num(np.clip(im_rr, 0, height - 1), copy = False)
+    im_cc = np.nan_to_num(np.clip(im_cc, 0, width - 1), copy = False)
+    r0 = np.minimum(im_rr.astype(np.intp), height - 2 if height > 1 else 0)
+    c0 = np.minimum(im_cc.astype(np.intp), width - 2 if width > 1 else 0)
+    r1 = np.minimum(r0 + 1, height - 1)
+    c1 = np.minimum(c0 + 1, width - 1)
+    # Only the interpolation weights are in float32.
+    dr = (im_rr - r0).astype(np.float32)[:, :, np.newaxis]
+    dc = (im_cc - c0).astype(np.float32)[:, :, np.newaxis]
+
+    values = im[r0, c0].astype(np.float32)
+    values *= (1 - dr) * (1 - dc)
+    values += im[r0, c1] * ((1 - dr) * dc)
+    values += im[r1, c0] * (dr * (1 - dc))
+    values += im[r1, c1] * (dr * dc)
+    return values
+
+
+def cast_samples(values, dtype):
+    """
+    Cast float32 samples to dtype, rounding and clipping for integer types.
+    :param values: Samples from sample_image.
+    :param dtype: Output type.
+    """
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        values = np.clip(np.rint(values), info.min, info.max)
+    return values.astype(dtype, copy = False)
 
 
 if __name__ == "__main__":